@@ -114,7 +114,7 @@ template = """
     .box{background:#1e1e1e;padding:20px;flex:1;border:1px solid #333;display:flex;flex-direction:column;}
     #drop-zone{border:2px dashed #555;padding:40px;text-align:center;cursor:pointer;margin-top:10px;}
     #drop-zone.hover{border-color:#4ea3ff;}
-    input,button{background:#333;color:#eee;border:1px solid #555;padding:8px;}
+    input,select,button{background:#333;color:#eee;border:1px solid #555;padding:8px;}
     button{cursor:pointer;margin-top:10px;}
     #progress-bar{width:100%;background:#333;margin-top:10px;height:20px;display:none;}
     #progress-bar .bar{height:100%;width:0;background:#4ea3ff;}
@@ -146,6 +146,31 @@ template = """
         <span id=\"fps-val\">1</span>
         <small>frames per second</small>
       </label>
+      <label>Mode
+        <select id=\"extract-mode\">
+          <option value=\"fps\">Fixed FPS</option>
+          <option value=\"scene\">Scene Changes</option>
+          <option value=\"keyframe\">Keyframes Only</option>
+          <option value=\"mpdecimate\">FPS + Drop Duplicates</option>
+        </select>
+        <small>how frames are selected</small>
+      </label>
+      <label>Scene Threshold
+        <input type=\"range\" id=\"scene\" min=\"0.05\" max=\"1\" value=\"0.3\" step=\"0.05\">
+        <span id=\"scene-val\">0.3</span>
+        <small>min scene score</small>
+      </label>
+      <label>Workers
+        <input type=\"range\" id=\"workers\" min=\"0\" max=\"32\" value=\"1\" step=\"1\">
+        <span id=\"workers-val\">1</span>
+        <small>parallel ffmpeg processes (0 = all cores)</small>
+      </label>
+      <label><input type=\"checkbox\" id=\"autocrop\"> Remove Black Bars
+        <small>detect letterbox once and crop while extracting</small>
+      </label>
+      <label><input type=\"checkbox\" id=\"stream\"> Stream Frames
+        <small>decode directly into deduplication</small>
+      </label>
       <label><input type=\"checkbox\" id=\"skip-extract\"> Skip Extraction</label>
     </details>
     <details class=\"step-box\">
@@ -155,6 +180,29 @@ template = """
         <span id=\"dedup-val\">8</span>
         <small>max hash distance</small>
       </label>
+      <label>Lookup
+        <select id=\"dedup-mode\">
+          <option value=\"linear\">All Kept Frames</option>
+          <option value=\"multiindex\">All Kept Frames (indexed)</option>
+          <option value=\"window\">Recent Frames Only</option>
+        </select>
+        <small>which kept frames are compared</small>
+      </label>
+      <label>Window
+        <input type=\"range\" id=\"dedup-window\" min=\"1\" max=\"256\" value=\"32\" step=\"1\">
+        <span id=\"dedup-window-val\">32</span>
+        <small>recent frames compared</small>
+      </label>
+      <label>Series
+        <input type=\"text\" id=\"series\" placeholder=\"none\">
+        <small>skip frames kept by earlier episodes</small>
+      </label>
+      <label>Semantic Threshold
+        <input type=\"range\" id=\"semantic\" min=\"0.8\" max=\"1\" value=\"0.95\" step=\"0.01\">
+        <span id=\"semantic-val\">0.95</span>
+        <small>max CLIP similarity</small>
+      </label>
+      <label><input type=\"checkbox\" id=\"semantic-dedup\"> Semantic (CLIP) Deduplication</label>
       <label><input type=\"checkbox\" id=\"skip-dedup\"> Skip Deduplication</label>
     </details>
     <details class=\"step-box\">
@@ -168,6 +216,18 @@ template = """
         <span id=\"scale-val\">4</span>
         <small>enlarge factor</small>
       </label>
+      <label>Target Size
+        <input type=\"range\" id=\"target\" min=\"0\" max=\"4096\" value=\"0\" step=\"64\">
+        <span id=\"target-val\">0</span>
+        <small>px on the chosen side, 0 = use factor</small>
+      </label>
+      <label>Target Side
+        <select id=\"target-side\">
+          <option value=\"short\">Short Side</option>
+          <option value=\"long\">Long Side</option>
+        </select>
+        <small>side the target size applies to</small>
+      </label>
       <label>Blur Limit
         <input type=\"range\" id=\"blur\" min=\"0\" max=\"300\" value=\"100\" step=\"1\">
         <span id=\"blur-val\">100</span>
@@ -178,6 +238,38 @@ template = """
         <span id=\"dark-val\">40</span>
         <small>min brightness</small>
       </label>
+      <label>Backend
+        <select id=\"upscale-backend\">
+          <option value=\"torch\">PyTorch</option>
+          <option value=\"onnx\">ONNX Runtime</option>
+          <option value=\"onnx-int8\">ONNX Runtime int8</option>
+        </select>
+        <small>ONNX is exported once to models/</small>
+      </label>
+      <label>Tiles
+        <select id=\"tile\">
+          <option value=\"off\">Whole Frames</option>
+          <option value=\"0\">Auto</option>
+          <option value=\"128\">128 px</option>
+          <option value=\"256\">256 px</option>
+          <option value=\"512\">512 px</option>
+        </select>
+        <small>tiles of several frames share a forward pass</small>
+      </label>
+      <label>Memory Limit
+        <input type=\"range\" id=\"tile-memory\" min=\"256\" max=\"16384\" value=\"2048\" step=\"256\">
+        <span id=\"tile-memory-val\">2048</span>
+        <small>MB per forward pass when tuning tiles</small>
+      </label>
+      <label>Cache Dir
+        <input type=\"text\" id=\"upscale-cache\" value=\"\" placeholder=\"cache/upscale\">
+        <small>reuse upscaled frames across runs (empty = off)</small>
+      </label>
+      <label>Cache Size
+        <input type=\"range\" id=\"upscale-cache-mb\" min=\"1024\" max=\"102400\" value=\"10240\" step=\"1024\">
+        <span id=\"upscale-cache-mb-val\">10240</span>
+        <small>MB before old entries are evicted</small>
+      </label>
       <label><input type=\"checkbox\" id=\"skip-upscale\"> Skip Upscaling</label>
     </details>
     <details class=\"step-box\">
@@ -192,11 +284,28 @@ template = """
         <span id=\"conf-val\">0.5</span>
         <small>min detection score</small>
       </label>
+      <label>Detection Size
+        <input type=\"range\" id=\"detect-size\" min=\"0\" max=\"1920\" value=\"640\" step=\"32\">
+        <span id=\"detect-size-val\">640</span>
+        <small>px of the proxy faces are found on (0 = full)</small>
+      </label>
+      <label>Track Every
+        <input type=\"range\" id=\"track\" min=\"0\" max=\"30\" value=\"0\" step=\"1\">
+        <span id=\"track-val\">0</span>
+        <small>detect every n-th frame and follow faces in between (0 = off)</small>
+      </label>
       <label>Batch Size
         <input type=\"range\" id=\"batch\" min=\"1\" max=\"16\" value=\"4\" step=\"1\">
         <span id=\"batch-val\">4</span>
         <small>images per batch</small>
       </label>
+      <label>Order
+        <select id=\"order\">
+          <option value=\"upscale_first\">Upscale, then Crop</option>
+          <option value=\"crop_first\">Crop, then Upscale</option>
+        </select>
+        <small>crop first upscales only the faces</small>
+      </label>
       <label><input type=\"checkbox\" id=\"skip-crop\"> Skip Cropping</label>
     </details>
     <details class=\"step-box\">
@@ -204,12 +313,57 @@ template = """
       <label>Trigger Word
         <input type=\"text\" id=\"trigger\" placeholder=\"video name\">
       </label>
+      <label>Tagger Backend
+        <select id=\"tagger-backend\">
+          <option value=\"onnx\">ONNX Runtime</option>
+          <option value=\"onnx-int8\">ONNX Runtime int8</option>
+        </select>
+        <small>int8 runs on the CPU and is compared with float</small>
+      </label>
+      <label>Tagger Threads
+        <input type=\"range\" id=\"tagger-threads\" min=\"0\" max=\"32\" value=\"0\" step=\"1\">
+        <span id=\"tagger-threads-val\">0</span>
+        <small>intra-op threads (0 = default)</small>
+      </label>
+      <label>Tagger Inter-op Threads
+        <input type=\"range\" id=\"tagger-inter\" min=\"0\" max=\"8\" value=\"0\" step=\"1\">
+        <span id=\"tagger-inter-val\">0</span>
+        <small>parallel graph branches (0 = sequential)</small>
+      </label>
+      <label>Graph Optimization
+        <select id=\"tagger-opt\">
+          <option value=\"all\">All</option>
+          <option value=\"extended\">Extended</option>
+          <option value=\"basic\">Basic</option>
+          <option value=\"disable\">Off</option>
+        </select>
+        <small>optimized model is saved to models/</small>
+      </label>
       <label><input type=\"checkbox\" id=\"skip-annot\"> Skip Annotation</label>
     </details>
     <details class=\"step-box\">
       <summary>Classification</summary>
       <label><input type=\"checkbox\" id=\"skip-class\"> Skip Classification</label>
     </details>
+    <details class=\"step-box\">
+      <summary>Storage</summary>
+      <label>Work Format
+        <select id=\"work-format\">
+          <option value=\"png\">PNG (fast)</option>
+          <option value=\"npy\">NumPy (uncompressed)</option>
+          <option value=\"webp\">WebP (lossless)</option>
+        </select>
+        <small>intermediate images</small>
+      </label>
+      <label>Output Format
+        <select id=\"output-format\">
+          <option value=\"png\">PNG</option>
+          <option value=\"jpg\">JPEG</option>
+          <option value=\"webp\">WebP</option>
+        </select>
+        <small>dataset images</small>
+      </label>
+    </details>
   </details>
   <div id=\"content\">
     <div class=\"box\">
@@ -332,13 +486,39 @@ template = """
       return {
         trigger_word: document.getElementById('trigger').value,
         fps: parseInt(document.getElementById('fps').value),
+        stream_frames: document.getElementById('stream').checked,
+        extraction_mode: document.getElementById('extract-mode').value,
+        scene_threshold: parseFloat(document.getElementById('scene').value),
+        extract_workers: parseInt(document.getElementById('workers').value),
+        autocrop: document.getElementById('autocrop').checked,
         dedup_threshold: parseInt(document.getElementById('dedup').value),
+        dedup_mode: document.getElementById('dedup-mode').value,
+        dedup_window: parseInt(document.getElementById('dedup-window').value),
+        series: document.getElementById('series').value,
+        semantic_dedup: document.getElementById('semantic-dedup').checked,
+        semantic_threshold: parseFloat(document.getElementById('semantic').value),
         scale: parseInt(document.getElementById('scale').value),
+        upscale_target: parseInt(document.getElementById('target').value),
+        upscale_target_side: document.getElementById('target-side').value,
         blur_threshold: parseFloat(document.getElementById('blur').value),
         dark_threshold: parseFloat(document.getElementById('dark').value),
+        upscale_tile: document.getElementById('tile').value,
+        upscale_backend: document.getElementById('upscale-backend').value,
+        upscale_cache_dir: document.getElementById('upscale-cache').value,
+        upscale_cache_mb: parseInt(document.getElementById('upscale-cache-mb').value),
+        upscale_memory_mb: parseInt(document.getElementById('tile-memory').value),
         margin: parseFloat(document.getElementById('margin').value),
         conf_threshold: parseFloat(document.getElementById('conf').value),
+        detect_size: parseInt(document.getElementById('detect-size').value),
+        track_every: parseInt(document.getElementById('track').value),
         batch_size: parseInt(document.getElementById('batch').value),
+        tagger_backend: document.getElementById('tagger-backend').value,
+        tagger_threads: parseInt(document.getElementById('tagger-threads').value),
+        tagger_inter_threads: parseInt(document.getElementById('tagger-inter').value),
+        tagger_optimization: document.getElementById('tagger-opt').value,
+        work_format: document.getElementById('work-format').value,
+        output_format: document.getElementById('output-format').value,
+        order: document.getElementById('order').value,
         skip_extraction: document.getElementById('skip-extract').checked,
         skip_deduplication: document.getElementById('skip-dedup').checked,
         skip_filtering: document.getElementById('skip-filter').checked,
@@ -351,13 +531,24 @@ template = """
 
     const pairs = [
       ['fps','fps-val'],
+      ['scene','scene-val'],
+      ['workers','workers-val'],
       ['dedup','dedup-val'],
+      ['dedup-window','dedup-window-val'],
+      ['semantic','semantic-val'],
       ['scale','scale-val'],
+      ['target','target-val'],
       ['blur','blur-val'],
       ['dark','dark-val'],
+      ['tile-memory','tile-memory-val'],
+      ['upscale-cache-mb','upscale-cache-mb-val'],
       ['margin','margin-val'],
       ['conf','conf-val'],
-      ['batch','batch-val']
+      ['detect-size','detect-size-val'],
+      ['track','track-val'],
+      ['batch','batch-val'],
+      ['tagger-threads','tagger-threads-val'],
+      ['tagger-inter','tagger-inter-val']
     ];
     for(const [id,val] of pairs){
       const s = document.getElementById(id);
@@ -406,13 +597,40 @@ def start():
     data = request.get_json(silent=True) or {}
 
     fps = int(data.get('fps', 1))
+    stream_frames = bool(data.get('stream_frames'))
+    extraction_mode = str(data.get('extraction_mode', 'fps'))
+    scene_threshold = float(data.get('scene_threshold', 0.3))
+    extract_workers = int(data.get('extract_workers', 1))
+    autocrop = bool(data.get('autocrop'))
     dedup_threshold = int(data.get('dedup_threshold', 8))
+    dedup_mode = str(data.get('dedup_mode', 'linear'))
+    dedup_window = int(data.get('dedup_window', 32))
+    series = str(data.get('series', '') or '')
+    semantic_dedup = bool(data.get('semantic_dedup'))
+    semantic_threshold = float(data.get('semantic_threshold', 0.95))
     scale = int(data.get('scale', 4))
+    upscale_target = int(data.get('upscale_target', 0))
+    upscale_target_side = str(data.get('upscale_target_side', 'short'))
     blur_threshold = float(data.get('blur_threshold', 100.0))
     dark_threshold = float(data.get('dark_threshold', 40.0))
+    upscale_tile = str(data.get('upscale_tile', 'off'))
+    upscale_tile = None if upscale_tile == 'off' else int(upscale_tile)
+    upscale_memory_mb = int(data.get('upscale_memory_mb', 2048))
+    upscale_backend = str(data.get('upscale_backend', 'torch'))
+    upscale_cache_dir = str(data.get('upscale_cache_dir', '')).strip()
+    upscale_cache_mb = int(data.get('upscale_cache_mb', 10240))
     margin = float(data.get('margin', 0.3))
     conf_threshold = float(data.get('conf_threshold', 0.5))
+    detect_size = int(data.get('detect_size', 640))
+    track_every = int(data.get('track_every', 0))
     batch_size = int(data.get('batch_size', 4))
+    tagger_backend = str(data.get('tagger_backend', 'onnx'))
+    tagger_threads = int(data.get('tagger_threads', 0))
+    tagger_inter_threads = int(data.get('tagger_inter_threads', 0))
+    tagger_optimization = str(data.get('tagger_optimization', 'all'))
+    work_format = str(data.get('work_format', 'png'))
+    output_format = str(data.get('output_format', 'png'))
+    order = str(data.get('order', 'upscale_first'))
     skip_extraction = bool(data.get('skip_extraction'))
     skip_deduplication = bool(data.get('skip_deduplication'))
     skip_filtering = bool(data.get('skip_filtering'))
@@ -440,13 +658,39 @@ def start():
                         trigger_word=data.get('trigger_word', tw) or tw,
                         progress_cb=update_progress,
                         fps=fps,
+                        stream_frames=stream_frames,
+                        extraction_mode=extraction_mode,
+                        scene_threshold=scene_threshold,
+                        extract_workers=extract_workers,
+                        autocrop=autocrop,
                         dedup_threshold=dedup_threshold,
+                        dedup_mode=dedup_mode,
+                        dedup_window=dedup_window,
+                        series=series,
+                        semantic_dedup=semantic_dedup,
+                        semantic_threshold=semantic_threshold,
                         scale=scale,
+                        upscale_target=upscale_target,
+                        upscale_target_side=upscale_target_side,
                         blur_threshold=blur_threshold,
                         dark_threshold=dark_threshold,
+                        upscale_tile=upscale_tile,
+                        upscale_memory_mb=upscale_memory_mb,
+                        upscale_backend=upscale_backend,
+                        upscale_cache_dir=upscale_cache_dir,
+                        upscale_cache_mb=upscale_cache_mb,
                         margin=margin,
                         conf_threshold=conf_threshold,
+                        detect_size=detect_size,
+                        track_every=track_every,
                         batch_size=batch_size,
+                        tagger_backend=tagger_backend,
+                        tagger_threads=tagger_threads,
+                        tagger_inter_threads=tagger_inter_threads,
+                        tagger_optimization=tagger_optimization,
+                        work_format=work_format,
+                        output_format=output_format,
+                        order=order,
                         skip_deduplication=skip_deduplication,
                         skip_filtering=skip_filtering,
                         skip_upscaling=skip_upscaling,
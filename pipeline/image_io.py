@@ -0,0 +1,72 @@
+"""Reading and writing images in the work and output directories."""
+
+from __future__ import annotations
+
+import io
+import os
+from pathlib import Path
+import shutil
+
+import numpy as np
+from PIL import Image
+
+# Intermediate formats for ``work/``. PNG uses a low zlib level, ``npy`` stores
+# the raw array and WebP is lossless at its fastest effort setting.
+WORK_FORMATS = ("png", "npy", "webp")
+OUTPUT_FORMATS = ("png", "jpg", "webp")
+
+_WORK_OPTIONS: dict[str, dict] = {
+    "png": {"compress_level": 1},
+    "npy": {},
+    "webp": {"lossless": True, "quality": 0, "method": 0},
+}
+_OUTPUT_OPTIONS: dict[str, dict] = {
+    "png": {},
+    "jpg": {"quality": 95},
+    "webp": {"quality": 95},
+}
+
+
+def load_image(path: Path) -> Image.Image:
+    """Open an image written by :func:`save_work` or any PIL format."""
+
+    if path.suffix == ".npy":
+        return Image.fromarray(np.load(path))
+    return Image.open(path)
+
+
+def save_work(img: Image.Image | np.ndarray, path: Path, fmt: str = "png") -> Path:
+    """Save an intermediate image, replacing the suffix of ``path`` with ``fmt``."""
+
+    if fmt not in _WORK_OPTIONS:
+        raise ValueError(f"Unsupported work format: {fmt}")
+    path = path.with_suffix(f".{fmt}")
+    if fmt == "npy":
+        np.save(path, np.asarray(img))
+        return path
+    if isinstance(img, np.ndarray):
+        img = Image.fromarray(img)
+    img.save(path, **_WORK_OPTIONS[fmt])
+    return path
+
+
+def link_image(src: Path, dst: Path) -> Path:
+    """Hardlink ``src`` to ``dst``, copying if the filesystem does not allow it."""
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+    return dst
+
+
+def encode_output(img: Image.Image, fmt: str = "png") -> bytes:
+    """Return ``img`` encoded as a final dataset image in ``fmt``."""
+
+    if fmt not in _OUTPUT_OPTIONS:
+        raise ValueError(f"Unsupported output format: {fmt}")
+    if fmt == "jpg" and img.mode != "RGB":
+        img = img.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG" if fmt == "jpg" else fmt.upper(), **_OUTPUT_OPTIONS[fmt])
+    return buf.getvalue()
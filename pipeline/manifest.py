@@ -0,0 +1,118 @@
+"""Frame manifests passed between pipeline stages.
+
+Every stage writes a ``manifest.jsonl`` into its work directory. Each line
+describes one image: the frame number it was extracted as, its presentation
+timestamp, the source video, the image path and free-form metadata that
+stages may add to. Downstream stages iterate the manifest instead of globbing
+the directory, so the order always follows the frame number.
+
+Stages that only select or group images do not copy them; their manifest
+simply points at the files written by an earlier stage.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+import json
+import os
+from pathlib import Path
+import re
+from typing import Any, Iterable
+
+MANIFEST_NAME = "manifest.jsonl"
+IMAGE_EXTS = {".png", ".npy", ".webp", ".jpg", ".jpeg"}
+
+_DIGITS_RE = re.compile(r"(\d+)")
+
+
+@dataclass
+class FrameRecord:
+    """One image tracked by a stage manifest."""
+
+    frame: int
+    pts: float | None
+    source: str
+    path: Path
+    meta: dict[str, Any] = field(default_factory=dict)
+
+
+def _natural_key(path: Path) -> list[Any]:
+    return [int(p) if p.isdigit() else p for p in _DIGITS_RE.split(str(path))]
+
+
+def _frame_number(path: Path, default: int) -> int:
+    numbers = _DIGITS_RE.findall(path.stem)
+    return int(numbers[0]) if numbers else default
+
+
+def scan(directory: Path) -> list[FrameRecord]:
+    """Build records for the images in ``directory`` in natural sort order."""
+
+    images = sorted(
+        (p for p in directory.rglob("*") if p.suffix.lower() in IMAGE_EXTS),
+        key=_natural_key,
+    )
+    return [
+        FrameRecord(_frame_number(p, idx), None, "", p.relative_to(directory))
+        for idx, p in enumerate(images, 1)
+    ]
+
+
+def read(directory: Path) -> list[FrameRecord]:
+    """Return the records of ``directory`` with paths resolved against it.
+
+    Directories without a manifest (for example user provided folders) are
+    scanned instead.
+    """
+
+    manifest = directory / MANIFEST_NAME
+    if manifest.exists():
+        records = []
+        with manifest.open(encoding="utf-8") as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                records.append(
+                    FrameRecord(
+                        frame=data["frame"],
+                        pts=data.get("pts"),
+                        source=data.get("source", ""),
+                        path=Path(data["path"]),
+                        meta=data.get("meta", {}),
+                    )
+                )
+    else:
+        records = scan(directory)
+    for rec in records:
+        rec.path = directory / rec.path
+    return records
+
+
+def referenced_dirs(directory: Path) -> set[Path]:
+    """Return the resolved directories holding the images of ``directory``."""
+
+    return {rec.path.resolve().parent for rec in read(directory)}
+
+
+def write(directory: Path, records: Iterable[FrameRecord]) -> Path:
+    """Write ``records`` to the manifest of ``directory``.
+
+    Paths are stored relative to ``directory``, also when they point into
+    another stage's directory.
+    """
+
+    directory.mkdir(parents=True, exist_ok=True)
+    manifest = directory / MANIFEST_NAME
+    with manifest.open("w", encoding="utf-8") as fh:
+        for rec in records:
+            path = Path(os.path.relpath(rec.path, directory))
+            data = {
+                "frame": rec.frame,
+                "pts": rec.pts,
+                "source": rec.source,
+                "path": path.as_posix(),
+                "meta": rec.meta,
+            }
+            fh.write(json.dumps(data) + "\n")
+    return manifest
@@ -1,3 +1,4 @@
+from contextlib import closing
 from pathlib import Path
 import os
 import shutil
@@ -5,6 +6,8 @@ import zipfile
 from typing import Callable
 import torch
 
+from . import manifest
+from .image_io import encode_output, load_image
 from .logging_utils import log_step
 from .steps import (
     frame_extraction,
@@ -15,6 +18,7 @@ from .steps import (
     cropping,
     annotation,
 )
+from .upscale_cache import UpscaleCache
 from .preloader import (
     detect_yolo_model,
     preload_yolo,
@@ -23,6 +27,9 @@ from .preloader import (
     get as get_model,
 )
 
+# Order of the upscaling and cropping stages, see ``Pipeline.run``.
+PIPELINE_ORDERS = ("upscale_first", "crop_first")
+
 
 class Pipeline:
     def __init__(
@@ -49,6 +56,31 @@ class Pipeline:
         if self.work_dir.exists():
             shutil.rmtree(self.work_dir)
 
+    def _prune(self, current: Path) -> None:
+        """Delete work directories the manifest of ``current`` no longer uses."""
+
+        used = manifest.referenced_dirs(current) | {current.resolve()}
+        for sub in self.work_dir.iterdir():
+            resolved = sub.resolve()
+            if sub.is_dir() and not any(d.is_relative_to(resolved) for d in used):
+                shutil.rmtree(sub)
+
+    def _write_images(self, zf: zipfile.ZipFile, source: Path, fmt: str) -> None:
+        """Add the images listed in the manifest of ``source`` to ``zf``.
+
+        Images go to ``images/<group>/`` as assigned by classification. Files
+        already stored as ``fmt`` are added as they are, all others are
+        re-encoded in memory.
+        """
+        for rec in manifest.read(source):
+            arcname = Path("images", rec.meta.get("group", ""), rec.path.name)
+            arcname = arcname.with_suffix(f".{fmt}")
+            if rec.path.suffix.lower() == f".{fmt}":
+                zf.write(rec.path, arcname)
+            else:
+                with load_image(rec.path) as img:
+                    zf.writestr(str(arcname), encode_output(img, fmt))
+
     def run(
         self,
         video_path: Path,
@@ -56,13 +88,39 @@ class Pipeline:
         trigger_word: str = "name",
         progress_cb: Callable[[int, str], None] | None = None,
         fps: int = 1,
+        stream_frames: bool = False,
+        extraction_mode: str = "fps",
+        scene_threshold: float = 0.3,
+        extract_workers: int = 1,
+        autocrop: bool = False,
         dedup_threshold: int = 8,
+        dedup_mode: str = "linear",
+        dedup_window: int = 32,
+        series: str = "",
+        semantic_dedup: bool = False,
+        semantic_threshold: float = 0.95,
         scale: int = 4,
+        upscale_target: int = 0,
+        upscale_target_side: str = "short",
         blur_threshold: float = 100.0,
         dark_threshold: float = 40.0,
+        upscale_tile: int | None = None,
+        upscale_memory_mb: int = 2048,
+        upscale_backend: str = "torch",
+        upscale_cache_dir: str = "",
+        upscale_cache_mb: int = 10240,
         margin: float = 0.3,
         conf_threshold: float = 0.5,
+        detect_size: int = 640,
+        track_every: int = 0,
         batch_size: int = 4,
+        tagger_backend: str = "onnx",
+        tagger_threads: int = 0,
+        tagger_inter_threads: int = 0,
+        tagger_optimization: str = "all",
+        work_format: str = "png",
+        output_format: str = "png",
+        order: str = "upscale_first",
         skip_deduplication: bool = False,
         skip_filtering: bool = False,
         skip_upscaling: bool = False,
@@ -80,27 +138,109 @@ class Pipeline:
             Tag to prepend to every caption. Defaults to ``"name"``.
         fps:
             Frames per second for extraction.
+        stream_frames:
+            Decode frames straight into deduplication instead of writing every
+            extracted frame to disk first. Ignored when deduplication is
+            skipped.
+        extraction_mode:
+            Frame selection mode, one of ``fps``, ``scene``, ``keyframe`` or
+            ``mpdecimate``.
+        scene_threshold:
+            Scene score required in the ``scene`` extraction mode.
+        extract_workers:
+            Number of parallel ffmpeg processes for extraction, ``0`` for one
+            per CPU core. Streaming always uses a single process.
+        autocrop:
+            Detect black letterbox or pillarbox bars once per video and crop
+            them away during extraction.
         dedup_threshold:
             Hamming distance for deduplication.
+        dedup_mode:
+            Near-duplicate lookup: ``linear``, ``multiindex`` or ``window``.
+        dedup_window:
+            Number of recently kept frames compared in ``window`` mode.
+        series:
+            Dataset name shared by the episodes of a series. Frames already
+            kept by an earlier job of the same series are dropped.
+        semantic_dedup:
+            Additionally drop frames whose CLIP embedding is too similar to a
+            kept frame.
+        semantic_threshold:
+            Cosine similarity above which frames count as duplicates.
         scale:
             Upscaling factor.
+        upscale_target:
+            Desired size in pixels of the ``upscale_target_side`` (``short``
+            or ``long``). The factor is then chosen per image and ``scale``
+            is ignored. ``0`` always enlarges by ``scale``.
         blur_threshold:
-            Minimum Laplacian variance to keep a frame.
+            Minimum Laplacian variance to keep a frame. Checked by filtering
+            on thumbnails, or by upscaling when filtering is skipped.
         dark_threshold:
             Minimum brightness level.
+        upscale_tile:
+            Tile size for upscaling, ``0`` to pick the fastest size
+            automatically or ``None`` to upscale whole frames.
+        upscale_memory_mb:
+            Memory budget of one forward pass when tuning the tile size.
+        upscale_backend:
+            ``torch``, ``onnx`` or ``onnx-int8``. The ONNX models are exported
+            to ``models/`` on first use.
+        upscale_cache_dir:
+            Directory of the content-addressed cache of upscaled images, e.g.
+            ``cache/upscale``. Empty, the default, disables it.
+        upscale_cache_mb:
+            Size limit of the upscale cache; least recently used entries are
+            deleted beyond it.
         margin:
             Extra border around detected faces.
         conf_threshold:
             YOLO confidence threshold.
+        detect_size:
+            Longest side of the reduced copy faces are detected on; boxes are
+            mapped back to the full image. ``0`` detects at full resolution.
+        track_every:
+            Run the face detector only on every n-th frame and on shot
+            changes and track the boxes in between. ``0`` detects every frame.
         batch_size:
-            How many images to process per YOLO batch.
+            How many images to process per YOLO and tagger batch.
+        tagger_backend:
+            ``onnx`` or ``onnx-int8``. The int8 tagger is quantized once to
+            ``models/`` and runs on the CPU; its top-10 tags are compared with
+            the float model on a sample of the images.
+        tagger_threads:
+            Intra-op threads of the tagger session, ``0`` for the default.
+        tagger_inter_threads:
+            Inter-op threads of the tagger session, ``0`` to run its graph
+            sequentially.
+        tagger_optimization:
+            onnxruntime graph optimization level of the tagger: ``disable``,
+            ``basic``, ``extended`` or ``all``. The optimized model is saved
+            to ``models/`` and reused.
+        work_format:
+            Format of intermediate images in the work directory: ``png``
+            (fast, low compression), ``npy`` or lossless ``webp``.
+        output_format:
+            Image format of the packaged dataset: ``png``, ``jpg`` or ``webp``.
+        order:
+            ``upscale_first`` upscales whole frames and crops faces from the
+            result. ``crop_first`` detects and crops faces on the original
+            frames, drops frames without a detection and upscales only the
+            crops.
         """
         try:
             device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            tagger_options = dict(
+                backend=tagger_backend,
+                threads=tagger_threads,
+                inter_threads=tagger_inter_threads,
+                optimization=tagger_optimization,
+            )
             if self.preload:
-                preload_realesrgan(device, 4)
+                for native in upscaling.MODEL_SCALES if upscale_target else (scale,):
+                    preload_realesrgan(device, native)
                 preload_yolo(self.yolo_model)
-                preload_tagger(device)
+                preload_tagger(device, **tagger_options)
 
             if progress_cb:
                 progress_cb(0, 'Starting')
@@ -117,20 +257,65 @@ class Pipeline:
             if progress_cb:
                 progress_cb(1, 'Frame Extraction')
             work_frames = self.work_dir / 'frames'
-            frames = frame_extraction.run(video_path, work_frames, fps=fps)
-            current = frames
+            work_dedup = self.work_dir / 'dedup'
+            streaming = stream_frames and not skip_deduplication
+            if streaming:
+                frames = frame_extraction.stream(
+                    video_path,
+                    fps=fps,
+                    mode=extraction_mode,
+                    scene_threshold=scene_threshold,
+                    autocrop=autocrop,
+                )
+            else:
+                frames = frame_extraction.run(
+                    video_path,
+                    work_frames,
+                    fps=fps,
+                    mode=extraction_mode,
+                    scene_threshold=scene_threshold,
+                    workers=extract_workers,
+                    autocrop=autocrop,
+                )
+                current = frames
 
             # Deduplication
-            work_dedup = self.work_dir / 'dedup'
-            if skip_deduplication:
+            if streaming:
+                if progress_cb:
+                    progress_cb(2, 'Deduplication')
+                # Stops ffmpeg if deduplication fails before the end.
+                with closing(frames):
+                    current = deduplication.run(
+                        frames,
+                        work_dedup,
+                        threshold=dedup_threshold,
+                        total=frame_extraction.estimate_count(video_path, fps),
+                        source=str(video_path),
+                        work_format=work_format,
+                        mode=dedup_mode,
+                        window=dedup_window,
+                        series=series or None,
+                        semantic_threshold=semantic_threshold if semantic_dedup else None,
+                        device=device,
+                    )
+            elif skip_deduplication:
                 if progress_cb:
                     progress_cb(2, 'Deduplication (skipped)')
                 deduped = current
             else:
                 if progress_cb:
                     progress_cb(2, 'Deduplication')
-                deduped = deduplication.run(current, work_dedup, threshold=dedup_threshold)
-                shutil.rmtree(current)
+                deduped = deduplication.run(
+                    current,
+                    work_dedup,
+                    threshold=dedup_threshold,
+                    mode=dedup_mode,
+                    window=dedup_window,
+                    source=str(video_path),
+                    series=series or None,
+                    semantic_threshold=semantic_threshold if semantic_dedup else None,
+                    device=device,
+                )
                 current = deduped
 
             # Filtering
@@ -142,53 +327,85 @@ class Pipeline:
             else:
                 if progress_cb:
                     progress_cb(3, 'Filtering')
-                filtered = filtering.run(current, work_filter)
-                shutil.rmtree(current)
-                current = filtered
-
-            # Upscaling
-            work_upscale = self.work_dir / 'upscaling'
-            if skip_upscaling:
-                if progress_cb:
-                    progress_cb(4, 'Upscaling (skipped)')
-                upscaled = current
-            else:
-                if progress_cb:
-                    progress_cb(4, 'Upscaling')
-                upscaled = upscaling.run(
+                filtered = filtering.run(
                     current,
-                    work_upscale,
-                    scale=scale,
+                    work_filter,
                     blur_threshold=blur_threshold,
                     dark_threshold=dark_threshold,
-                    model=get_model("realesrgan") if self.preload else None,
-                    device=device,
                 )
-                shutil.rmtree(current)
-                current = upscaled
+                current = filtered
 
-            # Cropping
-            work_crop = self.work_dir / 'cropping'
-            if skip_cropping:
-                if progress_cb:
-                    progress_cb(5, 'Cropping (skipped)')
-                cropped = current
-            else:
-                if progress_cb:
-                    progress_cb(5, 'Cropping')
-                cropped = cropping.run(
+            # Upscaling and cropping, in the requested order
+            if order not in PIPELINE_ORDERS:
+                raise ValueError(f"Unknown pipeline order: {order}")
+            crop_first = order == "crop_first"
+            stages = ('cropping', 'upscaling') if crop_first else ('upscaling', 'cropping')
+            for step, stage in enumerate(stages, 4):
+                if stage == 'upscaling':
+                    work_upscale = self.work_dir / 'upscaling'
+                    if skip_upscaling:
+                        if progress_cb:
+                            progress_cb(step, 'Upscaling (skipped)')
+                        continue
+                    if progress_cb:
+                        progress_cb(step, 'Upscaling')
+                    current = upscaling.run(
+                        current,
+                        work_upscale,
+                        scale=scale,
+                        blur_threshold=blur_threshold,
+                        dark_threshold=dark_threshold,
+                        models={
+                            native: get_model(f"realesrgan_x{native}")
+                            for native in upscaling.MODEL_SCALES
+                        }
+                        if self.preload
+                        else None,
+                        device=device,
+                        work_format=work_format,
+                        check_quality=skip_filtering,
+                        tile=upscale_tile,
+                        memory_limit_mb=upscale_memory_mb,
+                        backend=upscale_backend,
+                        target_size=upscale_target or None,
+                        target_side=upscale_target_side,
+                        cache=UpscaleCache(Path(upscale_cache_dir), upscale_cache_mb * 1024**2)
+                        if upscale_cache_dir
+                        else None,
+                    )
+                else:
+                    work_crop = self.work_dir / 'cropping'
+                    if skip_cropping:
+                        if progress_cb:
+                            progress_cb(step, 'Cropping (skipped)')
+                        continue
+                    if progress_cb:
+                        progress_cb(step, 'Cropping')
+                    current = cropping.run(
+                        current,
+                        work_crop,
+                        margin=margin,
+                        yolo_model=self.yolo_model,
+                        yolo=get_model("yolo") if self.preload else None,
+                        conf_threshold=conf_threshold,
+                        batch_size=batch_size,
+                        work_format=work_format,
+                        keep_unmatched=not crop_first,
+                        proxy_size=detect_size or None,
+                        track_every=track_every,
+                    )
+                self._prune(current)
+
+            captions_dir = self.output_dir / 'captions'
+            scores_dir = self.work_dir / 'tag_scores'
+            if tagger_backend == 'onnx-int8' and not (skip_annotation and skip_classification):
+                annotation.report_quantized(
                     current,
-                    work_crop,
-                    margin=margin,
-                    yolo_model=self.yolo_model,
-                    yolo=get_model("yolo") if self.preload else None,
-                    conf_threshold=conf_threshold,
+                    device,
+                    quantized=get_model("tagger") if self.preload else None,
                     batch_size=batch_size,
+                    **tagger_options,
                 )
-                shutil.rmtree(current)
-                current = cropped
-
-            captions_dir = self.output_dir / 'captions'
             if skip_annotation:
                 if progress_cb:
                     progress_cb(6, 'Annotation (skipped)')
@@ -200,6 +417,9 @@ class Pipeline:
                     captions_dir,
                     trigger_word=trigger_word,
                     preloaded=get_model("tagger") if self.preload else None,
+                    batch_size=batch_size,
+                    scores_dir=scores_dir,
+                    tagger_options=tagger_options,
                 )
 
             work_class = self.work_dir / 'classification'
@@ -214,22 +434,18 @@ class Pipeline:
                     current,
                     work_class,
                     preloaded=get_model("tagger") if self.preload else None,
+                    batch_size=batch_size,
+                    scores_dir=scores_dir,
+                    tagger_options=tagger_options,
                 )
-                shutil.rmtree(current)
                 current = classified
 
-            images_dir = self.output_dir / 'images'
-            shutil.copytree(current, images_dir)
-            if current.exists() and current != images_dir:
-                shutil.rmtree(current)
-            if work_crop.exists() and not skip_cropping:
-                shutil.rmtree(work_crop)
-
-            # Zip output
+            # Zip output straight from the work directory
             if progress_cb:
                 progress_cb(8, 'Packaging')
             zip_path = self.output_dir.with_suffix('.zip')
             with zipfile.ZipFile(zip_path, 'w') as zf:
+                self._write_images(zf, current, output_format)
                 for path in self.output_dir.rglob('*'):
                     zf.write(path, path.relative_to(self.output_dir))
             shutil.rmtree(self.output_dir)
@@ -9,7 +9,7 @@ from ultralytics import YOLO
 
 from .logging_utils import log_step
 from .steps.annotation import _load_tagger
-from .steps.upscaling import _load_model
+from .steps.upscaling import _load_model, model_scale
 
 MODELS_DIR = Path("models")
 
@@ -45,19 +45,27 @@ def preload_yolo(model_path: Path | None) -> Future[Any]:
     return fut
 
 
-def preload_tagger(device: torch.device) -> Future[Any]:
-    """Start loading the WD14 ONNX tagger in the background."""
+def preload_tagger(device: torch.device, **options: Any) -> Future[Any]:
+    """Start loading the WD14 ONNX tagger in the background.
 
-    fut = _executor.submit(_load_tagger, device)
+    ``options`` are passed to :func:`~pipeline.steps.annotation._load_tagger`.
+    """
+
+    fut = _executor.submit(_load_tagger, device, **options)
     _futures["tagger"] = fut
     return fut
 
 
 def preload_realesrgan(device: torch.device, scale: int) -> Future[Any]:
-    """Start loading RealESRGAN weights in the background."""
+    """Start loading RealESRGAN weights in the background.
+
+    The model is stored as ``realesrgan_x<n>`` where ``n`` is the native
+    scale of the model used for ``scale``.
+    """
 
+    scale = model_scale(scale)
     fut = _executor.submit(_load_model, device, scale)
-    _futures["realesrgan"] = fut
+    _futures[f"realesrgan_x{scale}"] = fut
     return fut
 
 
@@ -1,7 +1,9 @@
 """Automatic tagging using the WD14 tagger."""
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Any
+import os
+from typing import Iterator, List, Any
 import csv
 
 from PIL import Image
@@ -9,27 +11,118 @@ import torch
 from huggingface_hub import hf_hub_download
 import numpy as np
 import cv2
-from onnxruntime import InferenceSession
-
+from onnxruntime import (
+    ExecutionMode,
+    GraphOptimizationLevel,
+    InferenceSession,
+    SessionOptions,
+)
+
+from .. import manifest
+from ..image_io import load_image
 from ..logging_utils import log_step, log_progress
 
 
 _REPO = "SmilingWolf/wd-swinv2-tagger-v3"
+_MODEL_NAME = _REPO.split("/")[-1]
+# ``onnx`` runs the published float model, ``onnx-int8`` a dynamically
+# quantized copy on the CPU.
+TAGGER_BACKENDS = ("onnx", "onnx-int8")
+ONNX_DIR = Path("models")
+_OPTIMIZATION_LEVELS = {
+    "disable": GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
 _TAGS_FILE = "selected_tags.csv"
+_SCORES_FILE = "scores.npy"
+_KEYS_FILE = "keys.txt"
+# The first rows of the tag list are the rating classes, not caption tags.
+_RATING_TAGS = 4
+
+
+def _quantize_tagger(model_path: str) -> Path:
+    """Return the dynamically int8 quantized tagger, creating it on first use."""
+
+    path = ONNX_DIR / f"{_MODEL_NAME}_int8.onnx"
+    if not path.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        log_step(f"Quantizing tagger to {path}")
+        ONNX_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}")
+        quantize_dynamic(model_path, str(tmp), weight_type=QuantType.QInt8)
+        os.replace(tmp, path)
+    return path
+
+
+def _session_options(
+    threads: int, inter_threads: int, optimization: str
+) -> SessionOptions:
+    options = SessionOptions()
+    if threads:
+        options.intra_op_num_threads = threads
+    if inter_threads:
+        # Inter-op threads are only used when independent nodes run in parallel.
+        options.inter_op_num_threads = inter_threads
+        options.execution_mode = ExecutionMode.ORT_PARALLEL
+    options.graph_optimization_level = _OPTIMIZATION_LEVELS[optimization]
+    return options
+
+
+def _load_tagger(
+    device: torch.device,
+    *,
+    backend: str = "onnx",
+    threads: int = 0,
+    inter_threads: int = 0,
+    optimization: str = "all",
+) -> tuple[InferenceSession, int, List[str]]:
+    """Load the ONNX tagger model and tag list from the Hugging Face Hub.
 
-
-def _load_tagger(device: torch.device) -> tuple[InferenceSession, int, List[str]]:
-    """Load the ONNX tagger model and tag list from the Hugging Face Hub."""
+    Parameters
+    ----------
+    device:
+        Device to run the float model on.
+    backend:
+        One of :data:`TAGGER_BACKENDS`. ``onnx-int8`` always runs on the CPU.
+    threads:
+        Intra-op threads of the session, ``0`` for the onnxruntime default.
+    inter_threads:
+        Inter-op threads, ``0`` to run the graph sequentially.
+    optimization:
+        Graph optimization level: ``disable``, ``basic``, ``extended`` or
+        ``all``. The optimized graph is saved to :data:`ONNX_DIR` and loaded
+        without re-optimizing by later jobs.
+    """
 
     log_step("Downloading tagger weights")
     model_path = hf_hub_download(_REPO, "model.onnx")
     tags_path = hf_hub_download(_REPO, _TAGS_FILE)
 
+    quantized = backend == "onnx-int8"
+    if quantized:
+        model_path = str(_quantize_tagger(model_path))
+
     providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
-    if device.type == "cpu":
+    if device.type == "cpu" or quantized:
         providers = ["CPUExecutionProvider"]
 
-    session = InferenceSession(model_path, providers=providers)
+    options = _session_options(threads, inter_threads, optimization)
+    if optimization != "disable":
+        # Optimized graphs can contain provider specific nodes.
+        name = f"{_MODEL_NAME}_int8" if quantized else _MODEL_NAME
+        target = "cpu" if quantized else device.type
+        optimized = ONNX_DIR / f"{name}_{optimization}_{target}.ort.onnx"
+        if optimized.exists():
+            model_path = str(optimized)
+            options.graph_optimization_level = GraphOptimizationLevel.ORT_DISABLE_ALL
+        else:
+            ONNX_DIR.mkdir(parents=True, exist_ok=True)
+            options.optimized_model_filepath = str(optimized)
+
+    session = InferenceSession(model_path, sess_options=options, providers=providers)
 
     with open(tags_path, newline="") as csvfile:
         reader = csv.reader(csvfile)
@@ -66,26 +159,130 @@ def _preprocess_image(img: Image.Image, image_size: int) -> np.ndarray:
     return img
 
 
-def _tag_image(
+def _load_preprocessed(path: Path, image_size: int) -> np.ndarray:
+    with load_image(path) as img:
+        return _preprocess_image(img, image_size)
+
+
+def _score_batches(
     session: InferenceSession,
     image_size: int,
-    img_path: Path,
+    paths: List[Path],
+    *,
+    batch_size: int = 8,
+) -> Iterator[np.ndarray]:
+    """Yield ``(B, T)`` tagger score matrices for consecutive batches of ``paths``.
+
+    Images are decoded and preprocessed in a thread pool while the previous
+    batch runs through the model, then stacked into one ``[B, H, W, 3]``
+    input.
+    """
+
+    input_name = session.get_inputs()[0].name
+    label_name = session.get_outputs()[0].name
+    batches = [paths[i : i + batch_size] for i in range(0, len(paths), batch_size)]
+    with ThreadPoolExecutor() as pool:
+
+        def _submit(batch: List[Path]) -> List[Future]:
+            return [pool.submit(_load_preprocessed, p, image_size) for p in batch]
+
+        pending = _submit(batches[0]) if batches else []
+        for i in range(len(batches)):
+            tensors = np.concatenate([f.result() for f in pending])
+            pending = _submit(batches[i + 1]) if i + 1 < len(batches) else []
+            yield session.run([label_name], {input_name: tensors})[0]
+
+
+def _score_images(
+    session: InferenceSession,
+    image_size: int,
+    paths: List[Path],
+    *,
+    batch_size: int = 8,
+) -> np.ndarray:
+    """Return the ``(N, T)`` tagger scores of ``paths`` as one matrix."""
+
+    batches = list(_score_batches(session, image_size, paths, batch_size=batch_size))
+    if not batches:
+        return np.zeros((0, session.get_outputs()[0].shape[-1] or 0), dtype=np.float32)
+    return np.concatenate(batches)
+
+
+def _cached_scores(
+    session: InferenceSession,
+    image_size: int,
+    paths: List[Path],
+    *,
+    batch_size: int = 8,
+    scores_dir: Path | None = None,
+) -> np.ndarray:
+    """Return the ``(N, T)`` tagger scores of ``paths``, scoring each image once.
+
+    Scores are kept in ``scores_dir`` as a float16 matrix with one row per
+    image and a sidecar file listing the image paths, so annotation and
+    classification share a single forward pass. Images not yet in the matrix
+    are scored and appended. Without ``scores_dir`` every image is scored.
+    """
+
+    if scores_dir is None or not paths:
+        return _score_images(session, image_size, paths, batch_size=batch_size)
+
+    matrix_path = scores_dir / _SCORES_FILE
+    keys_path = scores_dir / _KEYS_FILE
+    keys = [str(p.resolve()) for p in paths]
+    cached_keys: List[str] = []
+    cached = None
+    if matrix_path.exists() and keys_path.exists():
+        cached_keys = keys_path.read_text().splitlines()
+        cached = np.load(matrix_path, mmap_mode="r")
+    index = {k: i for i, k in enumerate(cached_keys)}
+    missing = {k: p for k, p in zip(keys, paths) if k not in index}
+
+    if missing:
+        scores_dir.mkdir(parents=True, exist_ok=True)
+        tmp = scores_dir / f".{_SCORES_FILE}"
+        out = None
+        row = len(cached_keys)
+        todo = list(missing.values())
+        for batch in _score_batches(session, image_size, todo, batch_size=batch_size):
+            if out is None:
+                out = np.lib.format.open_memmap(
+                    tmp,
+                    mode="w+",
+                    dtype=np.float16,
+                    shape=(len(cached_keys) + len(todo), batch.shape[1]),
+                )
+                if cached is not None:
+                    out[: len(cached_keys)] = cached
+            out[row : row + len(batch)] = batch
+            row += len(batch)
+            log_progress("Tagging", row - len(cached_keys), len(todo))
+        out.flush()
+        del out, cached
+        os.replace(tmp, matrix_path)
+        cached_keys.extend(missing)
+        keys_path.write_text("\n".join(cached_keys) + "\n")
+        index = {k: i for i, k in enumerate(cached_keys)}
+        cached = np.load(matrix_path, mmap_mode="r")
+        log_step(f"Tagged {len(todo)} images, {len(paths) - len(todo)} from cache")
+
+    return cached[[index[k] for k in keys]]
+
+
+def _select_tags(
+    scores: np.ndarray,
     tags: List[str],
     *,
     threshold: float = 0.3,
     max_tags: int | None = None,
     min_tags: int | None = None,
 ) -> str:
-    """Return a comma-separated tag string for an image.
+    """Return a comma-separated tag string for one row of tagger scores.
 
     Parameters
     ----------
-    session:
-        Inference session for the WD14 model.
-    image_size:
-        Target image size expected by the model.
-    img_path:
-        Image to tag.
+    scores:
+        Model outputs for one image.
     tags:
         List of tag names corresponding to the model outputs.
     threshold:
@@ -99,29 +296,74 @@ def _tag_image(
         minimum is reached.
     """
 
-    with Image.open(img_path) as img:
-        img_tensor = _preprocess_image(img, image_size)
+    scores = np.asarray(scores[_RATING_TAGS : len(tags)], dtype=np.float32)
+    n = len(scores)
+    count = int(np.count_nonzero(scores > threshold))
+    if max_tags is not None:
+        count = min(count, max_tags)
+    k = min(max(count, min_tags or 0), n)
+    if k == 0:
+        return ""
 
-    input_name = session.get_inputs()[0].name
-    label_name = session.get_outputs()[0].name
-    scores = session.run([label_name], {input_name: img_tensor})[0][0]
+    # Only the k best scores are needed, so partition before sorting; ties
+    # keep tag-list order.
+    top = np.sort(np.argpartition(-scores, k - 1)[:k]) if k < n else np.arange(n)
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return ", ".join(tags[_RATING_TAGS + i] for i in top)
 
-    max_idx = min(len(tags), len(scores) - 4)
-    tag_scores = [
-        (tags[i], float(scores[i + 4])) for i in range(max_idx)
-    ]
-    tag_scores.sort(key=lambda x: x[1], reverse=True)
 
-    selected = [tag for tag, s in tag_scores if s > threshold]
+def report_quantized(
+    images_dir: Path,
+    device: torch.device,
+    *,
+    quantized: tuple[InferenceSession, int, List[str]] | None = None,
+    k: int = 10,
+    samples: int = 32,
+    batch_size: int = 8,
+    **options: Any,
+) -> float:
+    """Log how well the int8 tagger agrees with the float model.
+
+    Both models score up to ``samples`` images spread over ``images_dir``.
+    Returns the mean fraction of the float model's top-``k`` tags that the
+    quantized model also ranks in its top ``k``, or NaN if a model could not
+    be loaded.
 
-    if max_tags is not None:
-        selected = selected[:max_tags]
+    Parameters
+    ----------
+    quantized:
+        Already loaded ``onnx-int8`` tagger, loaded here if ``None``.
+    options:
+        Further keyword arguments for :func:`_load_tagger`.
+    """
+
+    options.pop("backend", None)
+    records = manifest.read(images_dir)
+    paths = [rec.path for rec in records[:: max(1, len(records) // samples)][:samples]]
+    if not paths:
+        return 1.0
+    try:
+        if quantized is None:
+            quantized = _load_tagger(device, backend="onnx-int8", **options)
+        reference = _load_tagger(device, backend="onnx", **options)
+    except Exception as exc:  # pragma: no cover - download may fail
+        log_step(f"Tagger accuracy report skipped: {exc}")
+        return float("nan")
 
-    if min_tags is not None and len(selected) < min_tags:
-        additional = [tag for tag, _ in tag_scores if tag not in selected]
-        selected.extend(additional[: min_tags - len(selected)])
+    def _top(tagger: tuple[InferenceSession, int, List[str]]) -> np.ndarray:
+        session, size, _ = tagger
+        scores = _score_images(session, size, paths, batch_size=batch_size)
+        return np.argpartition(-scores[:, _RATING_TAGS:], k - 1, axis=1)[:, :k]
 
-    return ", ".join(selected)
+    top_q, top_f = _top(quantized), _top(reference)
+    agreement = float(
+        np.mean([len(np.intersect1d(q, f)) / k for q, f in zip(top_q, top_f)])
+    )
+    log_step(
+        f"Tagger int8 top-{k} agreement with float on {len(paths)} images: "
+        f"{100 * agreement:.1f}%"
+    )
+    return agreement
 
 
 def run(
@@ -130,6 +372,9 @@ def run(
     *,
     trigger_word: str = "name",
     preloaded: tuple[InferenceSession, int, List[str]] | None = None,
+    batch_size: int = 8,
+    scores_dir: Path | None = None,
+    tagger_options: dict[str, Any] | None = None,
 ) -> None:
     """Run image annotation with automatic tagging and fallback.
 
@@ -141,6 +386,12 @@ def run(
         Output directory for generated caption files.
     trigger_word:
         The first tag to prepend to every caption. Defaults to ``"name"``.
+    batch_size:
+        Number of images per tagger forward pass.
+    scores_dir:
+        Directory of the tag score matrix shared with classification.
+    tagger_options:
+        Keyword arguments for :func:`_load_tagger` when nothing is preloaded.
     """
 
     captions_dir.mkdir(parents=True, exist_ok=True)
@@ -151,27 +402,23 @@ def run(
         if preloaded is not None:
             session, img_size, tags = preloaded
         else:
-            session, img_size, tags = _load_tagger(device)
+            session, img_size, tags = _load_tagger(device, **(tagger_options or {}))
     except Exception as exc:  # pragma: no cover - download may fail
         log_step(f"Tagger unavailable: {exc}; using fallback captions")
-        for img in sorted(cropped_dir.glob("*.png")):
+        for rec in manifest.read(cropped_dir):
+            img = rec.path
             caption_file = captions_dir / f"{img.stem}.txt"
             caption_file.write_text(f"{trigger_word}, anime_style")
         log_step("Annotation completed with fallback")
         return
 
-    images = sorted(cropped_dir.glob("*.png"))
+    images = [rec.path for rec in manifest.read(cropped_dir)]
     total = len(images)
-    for idx, img in enumerate(images, 1):
-        caption = _tag_image(
-            session,
-            img_size,
-            img,
-            tags,
-            threshold=0.3,
-            max_tags=30,
-            min_tags=10,
-        )
+    scores = _cached_scores(
+        session, img_size, images, batch_size=batch_size, scores_dir=scores_dir
+    )
+    for idx, (img, row) in enumerate(zip(images, scores), 1):
+        caption = _select_tags(row, tags, threshold=0.3, max_tags=30, min_tags=10)
         if caption:
             caption = f"{trigger_word}, {caption}"
         else:
@@ -1,9 +1,8 @@
 """Character classification based on hair, eye and style detection."""
 
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, List
 from onnxruntime import InferenceSession
-import shutil
 
 import torch
 import numpy as np
@@ -13,8 +12,10 @@ import umap
 from sklearn.cluster import KMeans
 from sklearn.metrics import silhouette_score
 
+from .. import manifest
+from ..image_io import load_image
 from ..logging_utils import log_step, log_progress
-from .annotation import _load_tagger, _tag_image
+from .annotation import _cached_scores, _load_tagger
 
 HAIR_COLORS = [
     "blonde hair",
@@ -67,49 +68,83 @@ EYE_COLORS = [
 ]
 
 
-def _detect_color(tag_str: str, colors: List[str], suffix: str) -> str:
-    for c in colors:
-        if c in tag_str:
-            return c.replace(suffix, "").strip()
-    return "unknown"
+_Index = tuple[np.ndarray, List[str]]
 
 
-def _detect_feature(tag_str: str, features: List[str]) -> str:
-    for f in features:
-        if f in tag_str:
-            return f.replace(" ", "_")
-    return "none"
+def _index(tags: List[str], names: List[str]) -> _Index:
+    """Return the score columns of ``names`` in ``tags`` and the names found.
 
+    The tagger's tag list spells tags with underscores, e.g. ``blue_hair``.
+    """
+
+    columns = {tag: i for i, tag in enumerate(tags)}
+    found = [n for n in names if n.replace(" ", "_") in columns]
+    indices = np.array([columns[n.replace(" ", "_")] for n in found], dtype=np.intp)
+    return indices, found
+
+
+def _attribute_indices(tags: List[str]) -> dict[str, _Index]:
+    return {
+        "hair": _index(tags, HAIR_COLORS),
+        "eyes": _index(tags, EYE_COLORS),
+        "length": _index(tags, HAIR_LENGTHS),
+        "accessory": _index(tags, ACCESSORIES),
+    }
+
+
+def _best(scores: np.ndarray, index: _Index, threshold: float) -> str | None:
+    """Return the highest scoring name of ``index`` if it exceeds ``threshold``."""
+
+    indices, names = index
+    if not len(indices):
+        return None
+    best = int(np.argmax(scores[indices]))
+    return names[best] if scores[indices[best]] > threshold else None
+
+
+def _detect_attributes(
+    scores: np.ndarray, indices: dict[str, _Index], threshold: float
+) -> tuple[str, str, str, str]:
+    hair = _best(scores, indices["hair"], threshold)
+    eyes = _best(scores, indices["eyes"], threshold)
+    length = _best(scores, indices["length"], threshold)
+    accessory = _best(scores, indices["accessory"], threshold)
+    return (
+        hair.replace(" hair", "") if hair else "unknown",
+        eyes.replace(" eyes", "") if eyes else "unknown",
+        length.replace(" ", "_") if length else "none",
+        accessory.replace(" ", "_") if accessory else "none",
+    )
+
+
+def _load_clip(device: str) -> tuple[Any, Callable[[Image.Image], torch.Tensor]]:
+    """Load the CLIP ViT-B-32 model and its preprocessing transform."""
 
-def _detect_attributes(tag_str: str) -> tuple[str, str, str, str]:
-    hair = _detect_color(tag_str, HAIR_COLORS, " hair")
-    eyes = _detect_color(tag_str, EYE_COLORS, " eyes")
-    length = _detect_feature(tag_str, HAIR_LENGTHS)
-    accessory = _detect_feature(tag_str, ACCESSORIES)
-    return hair, eyes, length, accessory
+    model, _, preprocess = open_clip.create_model_and_transforms(
+        "ViT-B-32", pretrained="laion2b_s34b_b79k"
+    )
+    model = model.to(device)
+    model.eval()
+    return model, preprocess
 
 
-def _cluster_unknowns(unclassified_dir: Path, *, n_clusters: int | None = None) -> None:
-    """Cluster images in ``unclassified_dir`` using CLIP embeddings and KMeans.
+def _cluster_unknowns(images: list[Path], *, n_clusters: int | None = None) -> list[int]:
+    """Cluster ``images`` using CLIP embeddings and KMeans.
 
     If ``n_clusters`` is ``None`` an optimal value is estimated via the
-    silhouette score in the range 2..10 (or the number of images).
+    silhouette score in the range 2..10 (or the number of images). Returns the
+    cluster label of every image.
     """
 
-    images = sorted(unclassified_dir.glob("*.png"))
     if not images:
-        return
+        return []
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    model, _, preprocess = open_clip.create_model_and_transforms(
-        "ViT-B-32", pretrained="laion2b_s34b_b79k"
-    )
-    model = model.to(device)
-    model.eval()
+    model, preprocess = _load_clip(device)
 
     feats = []
     for img_path in images:
-        with Image.open(img_path) as img:
+        with load_image(img_path) as img:
             img_t = preprocess(img).unsqueeze(0).to(device)
             with torch.no_grad():
                 emb = model.encode_image(img_t)
@@ -136,11 +171,7 @@ def _cluster_unknowns(unclassified_dir: Path, *, n_clusters: int | None = None)
         n_clusters = max(1, len(feats))
 
     labels = KMeans(n_clusters=n_clusters, random_state=42).fit_predict(reduced)
-
-    for img_path, label in zip(images, labels):
-        cluster_dir = unclassified_dir / f"cluster_{label:02d}"
-        cluster_dir.mkdir(exist_ok=True)
-        shutil.move(img_path, cluster_dir / img_path.name)
+    return [int(label) for label in labels]
 
 
 def run(
@@ -148,8 +179,18 @@ def run(
     workdir: Path,
     *,
     preloaded: tuple[InferenceSession, int, List[str]] | None = None,
+    batch_size: int = 8,
+    scores_dir: Path | None = None,
+    tagger_options: dict[str, Any] | None = None,
 ) -> Path:
-    """Group images into folders based on detected hair, eye and style tags."""
+    """Group images based on detected hair, eye and style tags.
+
+    Images are not copied; every manifest record gets a ``group`` entry naming
+    the folder it is packaged into. The tagger scores all images once in
+    batches of ``batch_size``; the lower fallback threshold reuses them, and
+    so does annotation when both share ``scores_dir``. ``tagger_options``
+    are passed to the tagger loader when nothing is preloaded.
+    """
 
     workdir.mkdir(parents=True, exist_ok=True)
     log_step("Classification started")
@@ -159,41 +200,50 @@ def run(
         if preloaded is not None:
             session, img_size, tags = preloaded
         else:
-            session, img_size, tags = _load_tagger(device)
+            session, img_size, tags = _load_tagger(device, **(tagger_options or {}))
     except Exception as exc:  # pragma: no cover - download may fail
         log_step(f"Tagger unavailable: {exc}; putting all images in 'unclassified'")
-        for img in sorted(images_dir.glob("*.png")):
-            char_dir = workdir / "unclassified"
-            char_dir.mkdir(exist_ok=True)
-            shutil.copy(img, char_dir / img.name)
+        records = manifest.read(images_dir)
+        for rec in records:
+            rec.meta["group"] = "unclassified"
+        manifest.write(workdir, records)
         log_step("Classification completed with fallback")
         return workdir
 
-    images = sorted(images_dir.glob("*.png"))
-    total = len(images)
-    for idx, img_path in enumerate(images, 1):
-        tag_str = _tag_image(session, img_size, img_path, tags, threshold=0.20)
-        hair, eyes, length, accessory = _detect_attributes(tag_str)
+    records = manifest.read(images_dir)
+    total = len(records)
+    scores = _cached_scores(
+        session,
+        img_size,
+        [rec.path for rec in records],
+        batch_size=batch_size,
+        scores_dir=scores_dir,
+    )
+    indices = _attribute_indices(tags)
+    for idx, (rec, row) in enumerate(zip(records, scores), 1):
+        row = np.asarray(row, dtype=np.float32)
+        hair, eyes, length, accessory = _detect_attributes(row, indices, 0.20)
         if hair == "unknown" or eyes == "unknown":
-            tag_str = _tag_image(session, img_size, img_path, tags, threshold=0.15)
-            hair, eyes, length, accessory = _detect_attributes(tag_str)
+            hair, eyes, length, accessory = _detect_attributes(row, indices, 0.15)
         if hair == "unknown" or eyes == "unknown":
-            char_dir = workdir / "unclassified"
+            group = "unclassified"
         else:
             parts = [hair, eyes]
             if length != "none":
                 parts.append(length)
             if accessory != "none":
                 parts.append(accessory)
-            char_dir = workdir / "_".join(parts)
-        char_dir.mkdir(exist_ok=True)
-        shutil.copy(img_path, char_dir / img_path.name)
+            group = "_".join(parts)
+        rec.meta["group"] = group
         log_progress("Classification", idx, total)
 
-    unclassified = workdir / "unclassified"
-    if unclassified.exists():
+    unclassified = [rec for rec in records if rec.meta["group"] == "unclassified"]
+    if unclassified:
         log_step("Clustering unclassified images")
-        _cluster_unknowns(unclassified)
+        labels = _cluster_unknowns([rec.path for rec in unclassified])
+        for rec, label in zip(unclassified, labels):
+            rec.meta["group"] = f"unclassified/cluster_{label:02d}"
+    manifest.write(workdir, records)
 
     log_step("Classification completed")
     return workdir
@@ -1,10 +1,14 @@
 """Face cropping step using ``animeface``, ``mediapipe`` or a YOLOv8 model."""
 
+from dataclasses import replace
+import hashlib
 from pathlib import Path
+import sqlite3
 
-import shutil
+import numpy as np
 from PIL import Image
 import animeface
+import cv2
 from ultralytics import YOLO
 import torch
 
@@ -13,8 +17,26 @@ try:  # Optional dependency for better face detection
 except Exception:  # pragma: no cover - library may be missing
     mp = None  # type: ignore
 
+from .. import manifest
+from ..image_io import link_image, load_image, save_work
 from ..logging_utils import log_step, log_progress
 
+DETECTIONS_DB = Path("cache/detections.sqlite")
+
+# Detectors run with this confidence and keep every box in the cache, so a
+# higher ``conf_threshold`` can be applied later without detecting again.
+_DETECT_CONF = 0.05
+
+# Tracking: boxes are searched in a window grown by this fraction of their
+# size and accepted above this normalised correlation. A mean grayscale
+# difference above ``_SHOT_DIFF`` counts as a shot change.
+_TRACK_SEARCH = 0.5
+_TRACK_MIN_SCORE = 0.6
+_SHOT_DIFF = 30.0
+_SHOT_SIZE = (64, 36)
+
+Box = tuple[int, int, int, int]
+
 
 def _crop_box(img: Image.Image, x: int, y: int, w: int, h: int, margin: float) -> Image.Image:
     """Return a cropped region defined by ``x``, ``y``, ``w`` and ``h`` with optional margin."""
@@ -28,22 +50,154 @@ def _crop_box(img: Image.Image, x: int, y: int, w: int, h: int, margin: float) -
     return img.crop((left, top, right, bottom))
 
 
-def _crop_animeface(img: Image.Image, margin: float) -> list[Image.Image]:
-    faces = animeface.detect(img)
-    crops = []
-    for face in faces:
-        box = face.face.pos
-        crops.append(_crop_box(img, box.x, box.y, box.width, box.height, margin))
-    return crops
+def _proxy(img: Image.Image, size: int | None) -> Image.Image:
+    """Return ``img`` reduced to a longest side of ``size`` for detection.
+
+    Boxes found on the proxy are normalised to its size and mapped back
+    onto ``img`` by :func:`_boxes`.
+    """
+
+    if size is None or max(img.size) <= size:
+        return img
+    ratio = max(img.size) / size
+    return img.resize(
+        (round(img.width / ratio), round(img.height / ratio)),
+        Image.BILINEAR,
+        reducing_gap=2.0,
+    )
+
+
+def _normalize(detections: list[tuple[Box, float]], size: tuple[int, int]) -> np.ndarray:
+    """Return ``(N, 5)`` rows of ``x, y, w, h, conf`` relative to ``size``."""
+
+    width, height = size
+    rows = [(x / width, y / height, w / width, h / height, c) for (x, y, w, h), c in detections]
+    return np.array(rows, dtype=np.float32).reshape(-1, 5)
+
+
+def _boxes(detections: np.ndarray, size: tuple[int, int], conf: float) -> list[Box]:
+    """Map normalised ``detections`` with at least ``conf`` onto ``size``."""
+
+    width, height = size
+    scale = np.array([width, height, width, height], dtype=np.float32)
+    kept = detections[detections[:, 4] >= conf, :4] * scale
+    return [tuple(int(round(v)) for v in row) for row in kept]  # type: ignore[misc]
+
+
+def _shot_change(prev: np.ndarray, cur: np.ndarray) -> bool:
+    """Return whether two grayscale proxies belong to different shots."""
+
+    if prev.shape != cur.shape:
+        return True
+    a = cv2.resize(prev, _SHOT_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+    b = cv2.resize(cur, _SHOT_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+    return float(np.abs(a - b).mean()) > _SHOT_DIFF
+
+
+def _track(prev: np.ndarray, cur: np.ndarray, detections: np.ndarray) -> np.ndarray | None:
+    """Move normalised ``detections`` from ``prev`` to ``cur`` by template matching.
+
+    Returns ``None`` if any box cannot be found with enough confidence, in
+    which case the frame has to be detected again.
+    """
+
+    height, width = prev.shape
+    tracked = []
+    for x, y, w, h, conf in detections:
+        px, py = int(x * width), int(y * height)
+        pw, ph = int(w * width), int(h * height)
+        template = prev[max(py, 0) : py + ph, max(px, 0) : px + pw]
+        if min(template.shape) < 8:
+            return None
+        ph, pw = template.shape
+        px, py = max(px, 0), max(py, 0)
+        mx, my = int(pw * _TRACK_SEARCH), int(ph * _TRACK_SEARCH)
+        x0, y0 = max(px - mx, 0), max(py - my, 0)
+        window = cur[y0 : py + ph + my, x0 : px + pw + mx]
+        if window.shape[0] < ph or window.shape[1] < pw:
+            return None
+        result = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (dx, dy) = cv2.minMaxLoc(result)
+        if not score >= _TRACK_MIN_SCORE:  # also rejects NaN on flat templates
+            return None
+        tracked.append(((x0 + dx) / width, (y0 + dy) / height, w, h, conf))
+    return np.array(tracked, dtype=np.float32).reshape(-1, 5)
+
 
+def _pixel_hash(img: Image.Image) -> str:
+    """Hash the decoded pixels, so re-encoded copies share their detections."""
 
-def _crop_mediapipe(img: Image.Image, detector: "mp.solutions.face_detection.FaceDetection", margin: float) -> list[Image.Image]:
-    """Crop faces using ``mediapipe`` if available."""
+    h = hashlib.blake2b(digest_size=16)
+    pixels = np.asarray(img)
+    h.update(str(pixels.shape).encode())
+    h.update(pixels.tobytes())
+    return h.hexdigest()
 
-    import numpy as np
+
+class _DetectionCache:
+    """Raw detections per decoded image and detector, persisted in SQLite.
+
+    Boxes are stored normalised to the image size together with their
+    confidence as a ``float32`` blob of ``x, y, w, h, conf`` rows. Boxes
+    followed by tracking are marked as such; they never replace detector
+    output and are only returned when ``tracked`` results are acceptable.
+    """
+
+    def __init__(self, db: Path, detector: str) -> None:
+        db.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS faces ("
+                "detector TEXT NOT NULL, hash TEXT NOT NULL, boxes BLOB NOT NULL, "
+                "tracked INTEGER NOT NULL, PRIMARY KEY (detector, hash))"
+            )
+        self._detector = detector
+        self._detected: list[tuple[str, str, bytes, int]] = []
+        self._tracked: list[tuple[str, str, bytes, int]] = []
+        self.hits = 0
+
+    def get(self, key: str, *, tracked: bool = False) -> np.ndarray | None:
+        row = self._conn.execute(
+            "SELECT boxes, tracked FROM faces WHERE detector = ? AND hash = ?",
+            (self._detector, key),
+        ).fetchone()
+        if row is None or (row[1] and not tracked):
+            return None
+        self.hits += 1
+        return np.frombuffer(row[0], dtype=np.float32).reshape(-1, 5)
+
+    def put(self, key: str, detections: np.ndarray, *, tracked: bool = False) -> None:
+        row = (self._detector, key, detections.astype(np.float32).tobytes(), int(tracked))
+        (self._tracked if tracked else self._detected).append(row)
+
+    def commit(self) -> None:
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO faces VALUES (?, ?, ?, ?)", self._detected
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO faces VALUES (?, ?, ?, ?)", self._tracked
+            )
+        self._conn.close()
+
+
+def _detect_animeface(img: Image.Image) -> list[tuple[Box, float]]:
+    detections = []
+    for face in animeface.detect(img):
+        pos = face.face.pos
+        conf = float(getattr(face, "likelihood", 1.0))
+        detections.append(((pos.x, pos.y, pos.width, pos.height), conf))
+    return detections
+
+
+def _detect_mediapipe(
+    img: Image.Image, detector: "mp.solutions.face_detection.FaceDetection"
+) -> list[tuple[Box, float]]:
+    """Detect faces using ``mediapipe`` if available."""
 
     results = detector.process(np.array(img))
-    crops: list[Image.Image] = []
+    detections: list[tuple[Box, float]] = []
     if results.detections:
         for det in results.detections:
             box = det.location_data.relative_bounding_box
@@ -51,29 +205,28 @@ def _crop_mediapipe(img: Image.Image, detector: "mp.solutions.face_detection.Fac
             y = int(box.ymin * img.height)
             w = int(box.width * img.width)
             h = int(box.height * img.height)
-            crops.append(_crop_box(img, x, y, w, h, margin))
-    return crops
+            detections.append(((x, y, w, h), float(det.score[0])))
+    return detections
 
 
-def _crop_yolo(imgs: list[Image.Image], model: YOLO, margin: float, conf: float) -> list[list[Image.Image]]:
-    """Return crops for a batch of images using YOLOv8."""
+def _detect_yolo(
+    imgs: list[Image.Image], model: YOLO, conf: float
+) -> list[list[tuple[Box, float]]]:
+    """Return face boxes and confidences for a batch of images using YOLOv8."""
 
-    results = model(imgs)
-    batch_crops: list[list[Image.Image]] = []
-    for img, res in zip(imgs, results):
-        img_crops = []
+    results = model(imgs, conf=conf, verbose=False)
+    batch: list[list[tuple[Box, float]]] = []
+    for res in results:
+        detections = []
         for box in res.boxes:
-            c = float(box.conf[0])
-            if c < conf:
-                continue
             x1, y1, x2, y2 = map(int, box.xyxy[0].tolist())
-            img_crops.append(_crop_box(img, x1, y1, x2 - x1, y2 - y1, margin))
-        batch_crops.append(img_crops)
-    return batch_crops
+            detections.append(((x1, y1, x2 - x1, y2 - y1), float(box.conf[0])))
+        batch.append(detections)
+    return batch
 
 
 def run(
-    upscaled_dir: Path,
+    input_dir: Path,
     workdir: Path,
     *,
     margin: float = 0.3,
@@ -82,13 +235,19 @@ def run(
     conf_threshold: float = 0.5,
     batch_size: int = 4,
     use_mediapipe: bool | None = None,
+    work_format: str = "png",
+    keep_unmatched: bool = True,
+    proxy_size: int | None = 640,
+    detections_db: Path | None = DETECTIONS_DB,
+    track_every: int = 0,
 ) -> Path:
     """Crop faces from images.
 
     Parameters
     ----------
-    upscaled_dir:
-        Directory with upscaled images.
+    input_dir:
+        Stage directory with the images, either upscaled frames or the
+        original frames when cropping runs before upscaling.
     workdir:
         Output directory for cropped results.
     margin:
@@ -97,68 +256,197 @@ def run(
     yolo_model:
         Optional path to a YOLOv8 model. If provided, YOLO detection is used.
     conf_threshold:
-        Minimum confidence for YOLO detections.
+        Minimum confidence for detections.
+    work_format:
+        Image format for the written crops.
+    keep_unmatched:
+        Pass frames without any detection on unchanged. When ``False`` they
+        are dropped.
+    proxy_size:
+        Detection runs on a copy reduced to this longest side and the boxes
+        are scaled back to cut from the full image. ``None`` detects on the
+        full image.
+    detections_db:
+        SQLite file caching the raw detections of every image by a hash of
+        its decoded pixels and the detector. Images found there are not
+        detected again, so cropping the same frames with another ``margin``
+        or ``conf_threshold`` only cuts and saves. ``None`` disables the
+        cache.
+    track_every:
+        Run the detector only on every ``track_every``-th frame and on shot
+        changes, following the boxes at or above ``conf_threshold`` in between
+        by template matching. A frame whose boxes cannot be followed, or whose
+        predecessor had no face above ``conf_threshold``, is
+        detected together with the rest of its ``batch_size`` batch. ``0`` or
+        ``1`` detects every frame. Frames must be in temporal order, which the manifest
+        guarantees.
     """
 
     workdir.mkdir(parents=True, exist_ok=True)
 
-    detector = None
-    if yolo is not None:
-        model = yolo
-        method = "yolo"
-        log_step("Cropping started with YOLOv8 (preloaded)")
-    elif yolo_model is not None:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        model = YOLO(str(yolo_model)).to(device)
+    if yolo is not None or yolo_model is not None:
         method = "yolo"
-        log_step("Cropping started with YOLOv8")
+        name = yolo_model.name if yolo_model is not None else Path(getattr(yolo, "ckpt_path", "") or "yolo").name
     elif (use_mediapipe is None and mp is not None) or (use_mediapipe is True and mp is not None):
-        detector = mp.solutions.face_detection.FaceDetection(min_detection_confidence=conf_threshold)
-        model = None
         method = "mediapipe"
-        log_step("Cropping started with mediapipe")
+        name = "face_detection"
     else:
-        model = None
         method = "animeface"
-        log_step("Cropping started with animeface")
+        name = "animeface"
+    detect_conf = min(_DETECT_CONF, conf_threshold)
+    cache = (
+        _DetectionCache(detections_db, f"{method}:{name}@{proxy_size or 'full'}")
+        if detections_db is not None
+        else None
+    )
+
+    model = None
+    detector = None
+
+    def _load_detector() -> None:
+        nonlocal model, detector
+        if method == "yolo":
+            if yolo is not None:
+                model = yolo
+                log_step("Cropping started with YOLOv8 (preloaded)")
+            else:
+                device = "cuda" if torch.cuda.is_available() else "cpu"
+                model = YOLO(str(yolo_model)).to(device)
+                log_step("Cropping started with YOLOv8")
+        elif method == "mediapipe":
+            detector = mp.solutions.face_detection.FaceDetection(min_detection_confidence=detect_conf)
+            log_step("Cropping started with mediapipe")
+        else:
+            log_step("Cropping started with animeface")
+
+    def _detect(proxies: list[Image.Image]) -> list[np.ndarray]:
+        if method == "yolo":
+            found = _detect_yolo(proxies, model, detect_conf)
+        elif method == "mediapipe":
+            found = [_detect_mediapipe(pr, detector) for pr in proxies]
+        else:
+            found = [_detect_animeface(pr) for pr in proxies]
+        return [_normalize(dets, pr.size) for dets, pr in zip(found, proxies)]
 
-    img_paths = sorted(upscaled_dir.glob("*.png"))
-    total = len(img_paths)
+    records = manifest.read(input_dir)
+    total = len(records)
     processed = 0
+    detected = 0
+    tracked = 0
+    tracking = track_every > 1
+    # Grayscale proxy and the boxes at or above ``conf_threshold`` of the
+    # last frame, which are the only ones tracked to the next frame.
+    reference: tuple[np.ndarray, np.ndarray] | None = None
+    since_detect = 0
+    out_records: list[manifest.FrameRecord] = []
 
-    if method == "yolo":
-        for i in range(0, len(img_paths), batch_size):
-            batch_paths = img_paths[i : i + batch_size]
-            imgs = [Image.open(p).convert("RGB") for p in batch_paths]
-            batch_crops = _crop_yolo(imgs, model, margin, conf_threshold)
-            for p, img, crops in zip(batch_paths, imgs, batch_crops):
-                if not crops:
-                    shutil.copy(p, workdir / p.name)
-                else:
-                    for idx, cropped in enumerate(crops):
-                        out_name = f"{p.stem}_{idx:02d}.png" if len(crops) > 1 else p.name
-                        cropped.save(workdir / out_name)
-                img.close()
-                processed += 1
-                log_progress("Cropping", processed, total)
-    else:
-        for p in img_paths:
-            with Image.open(p).convert("RGB") as img:
-                if method == "mediapipe" and detector is not None:
-                    crops = _crop_mediapipe(img, detector, margin)
-                else:
-                    crops = _crop_animeface(img, margin)
-
-                if not crops:
-                    shutil.copy(p, workdir / p.name)
-                    continue
-                for idx, cropped in enumerate(crops):
-                    out_name = f"{p.stem}_{idx:02d}.png" if len(crops) > 1 else p.name
-                    cropped.save(workdir / out_name)
+    def _save(rec: manifest.FrameRecord, img: Image.Image, detections: np.ndarray) -> None:
+        p = rec.path
+        if not (detections[:, 4] >= conf_threshold).any():
+            img.close()
+            if keep_unmatched:
+                out_records.append(replace(rec, path=link_image(p, workdir / p.name)))
+            return
+        boxes = _boxes(detections, img.size, conf_threshold)
+        for idx, box in enumerate(boxes):
+            cropped = _crop_box(img, *box, margin)
+            out_name = f"{p.stem}_{idx:02d}" if len(boxes) > 1 else p.stem
+            out_path = save_work(cropped, workdir / out_name, work_format)
+            out_records.append(
+                replace(rec, path=out_path, meta={**rec.meta, "crop": idx})
+            )
+        img.close()
+
+    def _detect_into(
+        js: list[int],
+        proxies: dict[int, Image.Image],
+        found: list[np.ndarray | None],
+        keys: list[str],
+    ) -> None:
+        """Detect the batch positions ``js`` in one call and record the boxes."""
+
+        nonlocal detected
+        if detected == 0:
+            _load_detector()
+        for j, dets in zip(js, _detect([proxies[j] for j in js])):
+            found[j] = dets
+            if cache is not None:
+                cache.put(keys[j], dets)
+        detected += len(js)
+
+    step = batch_size if method == "yolo" else 1
+    for i in range(0, len(records), step):
+        batch = records[i : i + step]
+        imgs = {j: load_image(rec.path).convert("RGB") for j, rec in enumerate(batch)}
+        keys = [_pixel_hash(imgs[j]) for j in range(len(batch))] if cache is not None else []
+        found: list[np.ndarray | None] = (
+            [cache.get(k, tracked=tracking) for k in keys]
+            if cache is not None
+            else [None] * len(batch)
+        )
+        missing = [j for j, dets in enumerate(found) if dets is None]
+        if missing:
+            proxies = {j: _proxy(imgs[j], proxy_size) for j in missing}
+            if not tracking:
+                _detect_into(missing, proxies, found, keys)
+            else:
+                grays = {j: np.asarray(proxies[j].convert("L")) for j in missing}
+                # Periodic frames and shot changes are detected whatever
+                # tracking finds, so they share one detector batch.
+                planned = []
+                prev = reference[0] if reference is not None else None
+                since = since_detect
+                for j in range(len(batch)):
+                    if j not in grays:
+                        # Cached frames carry no proxy to track from.
+                        prev = None
+                        continue
+                    if prev is None or since >= track_every - 1 or _shot_change(prev, grays[j]):
+                        planned.append(j)
+                        since = 0
+                    else:
+                        since += 1
+                    prev = grays[j]
+                if planned:
+                    _detect_into(planned, proxies, found, keys)
+                for j in range(len(batch)):
+                    if j not in grays:
+                        reference = None
+                        continue
+                    if found[j] is None:
+                        moved = None
+                        if reference is not None and len(reference[1]):
+                            moved = _track(reference[0], grays[j], reference[1])
+                        if moved is not None:
+                            found[j] = moved
+                            if cache is not None:
+                                cache.put(keys[j], moved, tracked=True)
+                            since_detect += 1
+                            tracked += 1
+                            reference = (grays[j], moved)
+                            continue
+                        # Lost the faces or had none to follow (one may have
+                        # entered the shot): detect the rest of the batch.
+                        rest = [k for k in missing if k >= j and found[k] is None]
+                        _detect_into(rest, proxies, found, keys)
+                    dets = found[j]
+                    reference = (grays[j], dets[dets[:, 4] >= conf_threshold])
+                    since_detect = 0
+        else:
+            reference = None
+        for j, rec in enumerate(batch):
+            _save(rec, imgs[j], found[j])
             processed += 1
             log_progress("Cropping", processed, total)
+    manifest.write(workdir, out_records)
     if detector is not None:
         detector.close()
+    if cache is not None:
+        cache.commit()
+        log_step(f"Cropping reused detections of {cache.hits}/{total} images")
+    if tracking:
+        log_step(f"Cropping ran the detector on {detected} frames, tracking saved {tracked} calls")
 
     log_step("Cropping completed")
     return workdir
+
@@ -1,43 +1,410 @@
 """Frame deduplication step using perceptual hashing."""
 
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
-import shutil
-from typing import List
+import sqlite3
+from typing import Callable, Iterable
 
+import numpy as np
 from PIL import Image
-import imagehash
+import torch
 
+from .. import manifest
+from ..image_io import load_image, save_work
 from ..logging_utils import log_step, log_progress
+from .classification import _load_clip
+from .frame_extraction import Frame
 
+INDEX_DB = Path("cache/dedup_index.sqlite")
 
-def run(frames_dir: Path, workdir: Path, threshold: int = 8) -> Path:
+_HASH_SIZE = 8
+_IMG_SIZE = _HASH_SIZE * 4
+_BATCH = 64
+# Streamed frames are held in memory at full resolution until a batch is done.
+_STREAM_BATCH = 16
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Return the unnormalised DCT-II matrix used by ``scipy.fftpack.dct``."""
+
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    return 2.0 * np.cos(np.pi * k * (2 * i + 1) / (2 * n))
+
+
+# Only the low-frequency rows of the DCT are needed for the hash.
+_DCT_LOW = _dct_matrix(_IMG_SIZE)[:_HASH_SIZE]
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:  # pragma: no cover - numpy < 2.0
+    _POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(x: np.ndarray) -> np.ndarray:
+        return _POPCOUNT8[x.view(np.uint8)].reshape(x.shape + (8,)).sum(-1)
+
+
+def _thumbnail(img: Image.Image) -> np.ndarray:
+    """Reduce ``img`` to the grayscale square that the perceptual hash reads."""
+
+    return np.asarray(img.convert("L").resize((_IMG_SIZE, _IMG_SIZE), Image.LANCZOS))
+
+
+def _load_thumbnail(path: Path) -> np.ndarray:
+    with load_image(path) as img:
+        return _thumbnail(img)
+
+
+def _phash_batch(thumbs: np.ndarray) -> np.ndarray:
+    """Return 64-bit perceptual hashes for a ``(B, 32, 32)`` thumbnail stack.
+
+    Bit-for-bit equivalent to ``imagehash.phash``: 2D DCT, keep the 8x8 low
+    frequencies and compare against their median. The bits are packed in
+    row-major order into big-endian ``uint64`` values.
+    """
+
+    low = _DCT_LOW @ thumbs.astype(np.float64) @ _DCT_LOW.T
+    flat = low.reshape(len(thumbs), -1)
+    bits = flat > np.median(flat, axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+# ``linear`` compares against every kept hash at once, ``multiindex`` answers
+# the same question in sublinear time and ``window`` only looks at the most
+# recently kept frames.
+DEDUP_MODES = ("linear", "multiindex", "window")
+
+
+class _LinearIndex:
+    """Growable ``uint64`` array of kept hashes with a vectorised lookup."""
+
+    def __init__(self) -> None:
+        self._hashes = np.empty(1024, dtype=np.uint64)
+        self._count = 0
+
+    def is_new(self, phash: np.uint64, threshold: int) -> bool:
+        """Return ``True`` if every kept hash is further than ``threshold`` bits away."""
+
+        if self._count == 0:
+            return True
+        dist = _popcount(self._hashes[: self._count] ^ phash)
+        return bool(dist.min() > threshold)
+
+    def add(self, phash: np.uint64) -> None:
+        if self._count == len(self._hashes):
+            self._hashes = np.resize(self._hashes, 2 * len(self._hashes))
+        self._hashes[self._count] = phash
+        self._count += 1
+
+
+class _MultiIndex:
+    """Multi-index hashing over 64-bit hashes.
+
+    Each hash is split into ``threshold + 1`` chunks and every chunk value is
+    a key into its own hash table. Two hashes within ``threshold`` bits must
+    agree exactly on at least one chunk (pigeonhole), so a query only verifies
+    the hashes sharing a bucket with it instead of every kept hash. Works best
+    for the usual thresholds up to about 10; above that the chunks get so
+    short that the buckets approach a full scan.
+    """
+
+    def __init__(self, threshold: int) -> None:
+        self._threshold = threshold
+        bounds = np.linspace(0, 64, threshold + 2).astype(int)
+        self._chunks = [(int(lo), (1 << int(hi - lo)) - 1) for lo, hi in zip(bounds[:-1], bounds[1:])]
+        # bucket -> [hashes, used length]
+        self._tables: list[dict[int, list]] = [{} for _ in self._chunks]
+
+    def is_new(self, phash: np.uint64, threshold: int) -> bool:
+        if threshold > self._threshold:
+            raise ValueError("query threshold exceeds the index threshold")
+        value = int(phash)
+        candidates = []
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            bucket = table.get((value >> shift) & mask)
+            if bucket is not None:
+                candidates.append(bucket[0][: bucket[1]])
+        if not candidates:
+            return True
+        return bool(_popcount(np.concatenate(candidates) ^ phash).min() > threshold)
+
+    def add(self, phash: np.uint64) -> None:
+        value = int(phash)
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            key = (value >> shift) & mask
+            bucket = table.get(key)
+            if bucket is None:
+                bucket = table[key] = [np.empty(8, dtype=np.uint64), 0]
+            if bucket[1] == len(bucket[0]):
+                bucket[0] = np.resize(bucket[0], 2 * len(bucket[0]))
+            bucket[0][bucket[1]] = phash
+            bucket[1] += 1
+
+
+class _WindowIndex:
+    """Compare only against the last ``size`` kept hashes (ring buffer)."""
+
+    def __init__(self, size: int) -> None:
+        self._hashes = np.empty(max(1, size), dtype=np.uint64)
+        self._count = 0
+        self._pos = 0
+
+    def is_new(self, phash: np.uint64, threshold: int) -> bool:
+        if self._count == 0:
+            return True
+        dist = _popcount(self._hashes[: self._count] ^ phash)
+        return bool(dist.min() > threshold)
+
+    def add(self, phash: np.uint64) -> None:
+        self._hashes[self._pos] = phash
+        self._pos = (self._pos + 1) % len(self._hashes)
+        self._count = min(self._count + 1, len(self._hashes))
+
+
+class _SeriesIndex:
+    """Hashes kept by earlier jobs of the same dataset, persisted in SQLite.
+
+    Rows from earlier runs of the same source video are replaced, so
+    re-running an episode does not drop its own frames.
+    """
+
+    def __init__(self, db: Path, dataset: str, source: str, threshold: int) -> None:
+        db.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "dataset TEXT NOT NULL, hash INTEGER NOT NULL, source TEXT, frame INTEGER)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS hashes_dataset ON hashes (dataset)")
+        self._conn.execute(
+            "DELETE FROM hashes WHERE dataset = ? AND source = ?", (dataset, source)
+        )
+        rows = self._conn.execute("SELECT hash FROM hashes WHERE dataset = ?", (dataset,))
+        # SQLite integers are signed, hashes are stored as their int64 view.
+        known = np.array([h for (h,) in rows], dtype=np.int64).view(np.uint64)
+        self._known = _MultiIndex(threshold)
+        for phash in known:
+            self._known.add(phash)
+        self._dataset = dataset
+        self._source = source
+        self._pending: list[tuple[str, int, str, int]] = []
+        self.size = len(known)
+
+    def is_new(self, phash: np.uint64, threshold: int) -> bool:
+        return self._known.is_new(phash, threshold)
+
+    def record(self, phash: np.uint64, frame: int) -> None:
+        value = int(np.array(phash, dtype=np.uint64).view(np.int64))
+        self._pending.append((self._dataset, value, self._source, frame))
+
+    def commit(self) -> None:
+        with self._conn:
+            self._conn.executemany("INSERT INTO hashes VALUES (?, ?, ?, ?)", self._pending)
+        self._conn.close()
+
+
+class _SemanticIndex:
+    """Normalised CLIP embeddings of kept frames with a cosine-similarity lookup."""
+
+    def __init__(self, threshold: float, device: torch.device) -> None:
+        self._threshold = threshold
+        self._device = device
+        self._model, self._preprocess = _load_clip(str(device))
+        self._embeddings: np.ndarray | None = None
+        self._count = 0
+
+    def embed(self, images: list[Image.Image], pool: ThreadPoolExecutor) -> np.ndarray:
+        """Return unit-length embeddings for ``images`` from one forward pass."""
+
+        batch = torch.stack(list(pool.map(self._preprocess, images))).to(self._device)
+        with torch.no_grad():
+            emb = self._model.encode_image(batch)
+        emb = emb / emb.norm(dim=-1, keepdim=True)
+        return emb.float().cpu().numpy()
+
+    def is_new(self, embedding: np.ndarray) -> bool:
+        if self._count == 0:
+            return True
+        sims = self._embeddings[: self._count] @ embedding
+        return bool(sims.max() <= self._threshold)
+
+    def add(self, embedding: np.ndarray) -> None:
+        if self._embeddings is None:
+            self._embeddings = np.empty((256, embedding.shape[0]), dtype=np.float32)
+        elif self._count == len(self._embeddings):
+            self._embeddings = np.concatenate([self._embeddings, np.empty_like(self._embeddings)])
+        self._embeddings[self._count] = embedding
+        self._count += 1
+
+
+def _make_index(
+    mode: str, threshold: int, window: int
+) -> _LinearIndex | _MultiIndex | _WindowIndex:
+    if mode == "linear":
+        return _LinearIndex()
+    if mode == "multiindex":
+        return _MultiIndex(threshold)
+    if mode == "window":
+        return _WindowIndex(window)
+    raise ValueError(f"Unknown deduplication mode: {mode}")
+
+
+def run(
+    frames: Path | Iterable[Frame],
+    workdir: Path,
+    threshold: int = 8,
+    *,
+    total: int | None = None,
+    source: str = "",
+    work_format: str = "png",
+    mode: str = "linear",
+    window: int = 32,
+    series: str | None = None,
+    index_db: Path = INDEX_DB,
+    semantic_threshold: float | None = None,
+    device: torch.device | None = None,
+) -> Path:
     """Remove near-duplicate frames using perceptual hash.
 
     Parameters
     ----------
-    frames_dir:
-        Directory containing extracted frames.
+    frames:
+        Directory containing extracted frames, or an iterable of decoded
+        frames as produced by :func:`frame_extraction.stream`. Streamed frames
+        are only written to ``workdir`` if they are kept.
     workdir:
-        Destination directory for deduplicated frames.
+        Destination directory for the manifest of kept frames. Kept frames
+        from a directory are referenced in place; only streamed frames are
+        written here.
     threshold:
         Maximum Hamming distance between perceptual hashes to consider frames
         duplicates. Lower values remove more images.
+    total:
+        Expected number of streamed frames, used for progress logging.
+    source:
+        Source video recorded in the manifest for streamed frames and in the
+        series index.
+    work_format:
+        Image format used when writing kept streamed frames.
+    mode:
+        Lookup strategy, one of :data:`DEDUP_MODES`. ``linear`` and ``multiindex``
+        keep the same frames; ``window`` only compares each frame with the
+        last ``window`` kept frames, which scales linearly with video length.
+    window:
+        Number of recently kept frames compared in ``window`` mode.
+    series:
+        Dataset name shared by all episodes of a series. If given, frames
+        within ``threshold`` of a frame kept by an earlier job of the same
+        series are dropped as well, and the kept hashes are stored for later
+        jobs.
+    index_db:
+        SQLite database holding the hashes of every series.
+    semantic_threshold:
+        If given, frames that pass the hash check are also compared by CLIP
+        ViT-B-32 embedding and dropped when their cosine similarity to a kept
+        frame exceeds this value. This catches pans, zooms and small motions
+        that perceptual hashes miss.
+    device:
+        Torch device for the CLIP model.
     """
 
     workdir.mkdir(parents=True, exist_ok=True)
-    log_step("Deduplication started")
+    log_step(f"Deduplication started (mode={mode})")
+
+    hashes = _make_index(mode, threshold, window)
+    known = None
+    if series:
+        known = _SeriesIndex(index_db, series, source, threshold)
+        log_step(f"Deduplication against {known.size} hashes from series '{series}'")
+    semantic = None
+    if semantic_threshold is not None:
+        if device is None:
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        semantic = _SemanticIndex(semantic_threshold, device)
+        log_step(f"Deduplication also compares CLIP embeddings (> {semantic_threshold})")
+    kept: list[manifest.FrameRecord] = []
+    seen_before = 0
+
+    def _decide(
+        numbers: list[int],
+        thumbs: np.ndarray,
+        open_image: Callable[[int], Image.Image],
+        pool: ThreadPoolExecutor,
+    ) -> list[tuple[bool, np.uint64]]:
+        """Return keep decisions and hashes for one batch, in order."""
+
+        nonlocal seen_before
+        phashes = _phash_batch(thumbs)
+        embeddings: dict[int, np.ndarray] = {}
+        if semantic is not None:
+            # The hash index only grows, so frames rejected by it now stay
+            # rejected; only the others need an embedding.
+            candidates = [i for i, h in enumerate(phashes) if hashes.is_new(h, threshold)]
+            if candidates:
+                embs = semantic.embed([open_image(i) for i in candidates], pool)
+                embeddings = dict(zip(candidates, embs))
 
-    hashes: List[imagehash.ImageHash] = []
-    frames = sorted(frames_dir.glob("*.png"))
-    total = len(frames)
-    for idx, frame in enumerate(frames, 1):
-        with Image.open(frame) as img:
-            phash = imagehash.phash(img)
+        decisions = []
+        for i, (number, phash) in enumerate(zip(numbers, phashes)):
+            keep = hashes.is_new(phash, threshold)
+            if keep and known is not None and not known.is_new(phash, threshold):
+                seen_before += 1
+                keep = False
+            if keep and semantic is not None:
+                keep = semantic.is_new(embeddings[i])
+            if keep:
+                hashes.add(phash)
+                if known is not None:
+                    known.record(phash, number)
+                if semantic is not None:
+                    semantic.add(embeddings[i])
+            decisions.append((keep, phash))
+        return decisions
 
-        if all(phash - h > threshold for h in hashes):
-            hashes.append(phash)
-            shutil.copy(frame, workdir / frame.name)
-        log_progress("Deduplication", idx, total)
+    with ThreadPoolExecutor() as pool:
+        if isinstance(frames, Path):
+            records = manifest.read(frames)
+            total = len(records)
+            for start in range(0, total, _BATCH):
+                batch = records[start : start + _BATCH]
+                thumbs = np.stack(list(pool.map(_load_thumbnail, [r.path for r in batch])))
+                decisions = _decide(
+                    [r.frame for r in batch],
+                    thumbs,
+                    lambda i: load_image(batch[i].path).convert("RGB"),
+                    pool,
+                )
+                for idx, (rec, (keep, phash)) in enumerate(zip(batch, decisions), start + 1):
+                    if keep:
+                        rec.meta["phash"] = f"{int(phash):016x}"
+                        kept.append(rec)
+                    log_progress("Deduplication", idx, total)
+        else:
+            frames = iter(frames)
+            idx = 0
+            while batch := list(islice(frames, _STREAM_BATCH)):
+                images = [Image.fromarray(f.image) for f in batch]
+                thumbs = np.stack([_thumbnail(img) for img in images])
+                decisions = _decide([f.index for f in batch], thumbs, images.__getitem__, pool)
+                for frame, img, (keep, phash) in zip(batch, images, decisions):
+                    idx += 1
+                    if keep:
+                        out_path = save_work(img, workdir / f"frame_{frame.index:06d}", work_format)
+                        kept.append(
+                            manifest.FrameRecord(
+                                frame.index,
+                                frame.timestamp,
+                                source,
+                                out_path,
+                                {"phash": f"{int(phash):016x}"},
+                            )
+                        )
+                    log_progress("Deduplication", idx, max(idx, total or 0))
 
+    manifest.write(workdir, kept)
+    if known is not None:
+        known.commit()
+        log_step(f"Deduplication dropped {seen_before} frames seen in earlier jobs")
     log_step("Deduplication completed")
     return workdir
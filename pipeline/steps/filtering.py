@@ -1,17 +1,144 @@
+"""Quality filtering on thumbnails and full-resolution sharpness."""
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
-import shutil
+
+import numpy as np
+from PIL import Image
+import cv2
+
+from .. import manifest
+from ..image_io import load_image
 from ..logging_utils import log_step, log_progress
 
+# Longest side of the thumbnails the metrics are computed on.
+THUMB_SIZE = 256
+
+_BATCH = 64
+# Frames whose grayscale standard deviation is below this are solid colour.
+_SOLID_STD = 6.0
+# Credit and title cards: at least this share of pixels sits on the background
+# level, the background is near black or near white and the frame is grey.
+_CARD_BACKGROUND = 0.85
+_CARD_TOLERANCE = 12
+_CARD_SATURATION = 16.0
+
+# Checked in this order; a frame is counted under the first reason it hits.
+REJECT_REASONS = ("solid", "card", "dark", "blur")
+
+
+def _load(path: Path) -> tuple[np.ndarray, float]:
+    """Return an ``(H, W, 3)`` thumbnail of ``path`` and its sharpness.
+
+    Sharpness is the Laplacian variance of the full-resolution grayscale
+    frame. A thumbnail's variance is not proportional to it (blurred frames
+    lose far less of it than sharp ones), so thresholds keep their meaning
+    only at full size.
+    """
+
+    with load_image(path) as img:
+        img = img.convert("RGB")
+        gray = np.asarray(img.convert("L"))
+        sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+        img.thumbnail((THUMB_SIZE, THUMB_SIZE), Image.BILINEAR)
+        return np.asarray(img), sharpness
+
+
+def _metrics(thumbs: np.ndarray, sharpness: np.ndarray) -> dict[str, np.ndarray]:
+    """Return per-image quality metrics for a ``(B, H, W, 3)`` ``uint8`` stack."""
+
+    rgb = thumbs.astype(np.float32)
+    # Same weights as ``Image.convert("L")``.
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    flat = gray.reshape(len(gray), -1)
+    background = np.median(flat, axis=1, keepdims=True)
+    return {
+        "sharpness": sharpness,
+        "brightness": flat.mean(axis=1),
+        "contrast": flat.std(axis=1),
+        "background": background.ravel(),
+        "background_share": (np.abs(flat - background) <= _CARD_TOLERANCE).mean(axis=1),
+        "saturation": (rgb.max(axis=-1) - rgb.min(axis=-1)).reshape(len(rgb), -1).mean(axis=1),
+    }
+
+
+def _reasons(
+    metrics: dict[str, np.ndarray], blur_threshold: float, dark_threshold: float
+) -> dict[str, np.ndarray]:
+    """Return a boolean mask per entry of :data:`REJECT_REASONS`."""
+
+    background = metrics["background"]
+    return {
+        "blur": metrics["sharpness"] < blur_threshold,
+        "dark": metrics["brightness"] < dark_threshold,
+        "solid": metrics["contrast"] < _SOLID_STD,
+        "card": (metrics["background_share"] >= _CARD_BACKGROUND)
+        & ((background < 40) | (background > 215))
+        & (metrics["saturation"] < _CARD_SATURATION),
+    }
+
+
+def run(
+    input_dir: Path,
+    workdir: Path,
+    *,
+    blur_threshold: float = 100.0,
+    dark_threshold: float = 40.0,
+) -> Path:
+    """Drop blurry, dark, solid-colour frames and credit or title cards.
+
+    Parameters
+    ----------
+    input_dir: Path
+        Stage directory whose manifest lists the candidate frames.
+    workdir: Path
+        Directory receiving the manifest of the kept frames. No images are
+        copied.
+    blur_threshold: float, optional
+        Minimum Laplacian variance of the full-resolution frame.
+    dark_threshold: float, optional
+        Minimum mean brightness (0..255).
 
-def run(classified_dir: Path, workdir: Path) -> Path:
-    """Placeholder filtering step."""
+    Frames are decoded in a thread pool; everything but sharpness is scored
+    in batches on thumbnails with a longest side of :data:`THUMB_SIZE`. Kept
+    records get their metrics in ``meta["quality"]``.
+    """
     workdir.mkdir(parents=True, exist_ok=True)
     log_step('Filtering started')
-    images = sorted(classified_dir.rglob('*.png'))
-    total = len(images)
-    for idx, img in enumerate(images, 1):
-        # flatten the directory structure for downstream steps
-        shutil.copy(img, workdir / img.name)
-        log_progress('Filtering', idx, total)
-    log_step('Filtering completed')
+    records = manifest.read(input_dir)
+    total = len(records)
+    kept: list[manifest.FrameRecord] = []
+    rejected = dict.fromkeys(REJECT_REASONS, 0)
+    done = 0
+    it = iter(records)
+    with ThreadPoolExecutor() as pool:
+        while batch := list(islice(it, _BATCH)):
+            loaded = list(pool.map(_load, [r.path for r in batch]))
+            thumbs = [thumb for thumb, _ in loaded]
+            sharpness = np.array([value for _, value in loaded], dtype=np.float32)
+            # Thumbnails only stack when the frames share an aspect ratio.
+            groups: dict[tuple[int, ...], list[int]] = {}
+            for i, thumb in enumerate(thumbs):
+                groups.setdefault(thumb.shape, []).append(i)
+            keep = np.ones(len(batch), dtype=bool)
+            for idx in groups.values():
+                metrics = _metrics(np.stack([thumbs[i] for i in idx]), sharpness[idx])
+                reasons = _reasons(metrics, blur_threshold, dark_threshold)
+                for j, i in enumerate(idx):
+                    hit = [name for name in REJECT_REASONS if reasons[name][j]]
+                    if hit:
+                        keep[i] = False
+                        rejected[hit[0]] += 1
+                    else:
+                        batch[i].meta["quality"] = {
+                            "sharpness": round(float(metrics["sharpness"][j]), 2),
+                            "brightness": round(float(metrics["brightness"][j]), 2),
+                        }
+            kept.extend(rec for rec, k in zip(batch, keep) if k)
+            done += len(batch)
+            log_progress('Filtering', done, total)
+    manifest.write(workdir, kept)
+    summary = ", ".join(f"{name}={count}" for name, count in rejected.items())
+    log_step(f'Filtering completed: {len(kept)}/{total} kept, rejected {summary}')
     return workdir
@@ -1,15 +1,45 @@
 """Frame extraction step using ffmpeg."""
 
 from pathlib import Path
+import math
+import os
+import queue
+import re
 import shutil
 import subprocess
-from typing import Iterable
+from threading import Thread
+from typing import IO, Iterable, Iterator, NamedTuple
 
+import numpy as np
+
+from .. import manifest
 from ..logging_utils import log_step
 
 
 SUPPORTED_EXTS: Iterable[str] = {".mp4", ".mkv", ".avi", ".mov", ".webm"}
 
+# ``fps`` samples at a fixed rate, ``scene`` keeps frames whose scene score
+# exceeds a threshold, ``keyframe`` decodes only keyframes and ``mpdecimate``
+# samples at ``fps`` but drops frames that barely differ from the last one.
+EXTRACTION_MODES = ("fps", "scene", "keyframe", "mpdecimate")
+
+# Extracted frames are intermediates, so favour encode speed over file size.
+_PNG_ARGS = ["-compression_level", "1"]
+
+_PTS_RE = re.compile(r"pts_time:\s*(-?[\d.]+)")
+_CROP_RE = re.compile(r"crop=(\d+):(\d+):(\d+):(\d+)")
+
+# Luma below which ``cropdetect`` treats a border pixel as black.
+_CROP_LIMIT = 24
+
+
+class Frame(NamedTuple):
+    """A decoded frame yielded by :func:`stream`."""
+
+    index: int
+    timestamp: float
+    image: np.ndarray
+
 
 def _check_ffmpeg() -> None:
     """Ensure ffmpeg is available."""
@@ -17,7 +47,311 @@ def _check_ffmpeg() -> None:
         raise EnvironmentError("ffmpeg is not installed or not in PATH")
 
 
-def run(video: Path, workdir: Path, fps: int = 1) -> Path:
+def _check_video(video: Path) -> None:
+    if video.suffix.lower() not in SUPPORTED_EXTS:
+        raise ValueError(f"Unsupported video format: {video.suffix}")
+
+
+def _probe(video: Path) -> tuple[int, int, float]:
+    """Return width, height and duration in seconds of ``video``."""
+
+    if not shutil.which("ffprobe"):
+        raise EnvironmentError("ffprobe is not installed or not in PATH")
+    out = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "stream=width,height:format=duration",
+            "-of",
+            "default=noprint_wrappers=1",
+            str(video),
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    ).stdout
+    info = dict(line.split("=", 1) for line in out.splitlines() if "=" in line)
+    duration = float(info["duration"]) if info.get("duration", "N/A") != "N/A" else 0.0
+    return int(info["width"]), int(info["height"]), duration
+
+
+def _mode_args(mode: str, fps: int, scene_threshold: float) -> tuple[list[str], list[str]]:
+    """Return ffmpeg input and output arguments for an extraction ``mode``."""
+
+    if mode == "fps":
+        return [], ["-vf", f"fps={fps}"]
+    if mode == "scene":
+        return [], ["-vf", f"select='gt(scene,{scene_threshold})'", "-vsync", "vfr"]
+    if mode == "keyframe":
+        return ["-skip_frame", "nokey"], ["-vsync", "vfr"]
+    if mode == "mpdecimate":
+        return [], ["-vf", f"fps={fps},mpdecimate", "-vsync", "vfr"]
+    raise ValueError(f"Unknown extraction mode: {mode}")
+
+
+def detect_crop(video: Path) -> tuple[int, int, int, int] | None:
+    """Return the active picture area of ``video`` as ``(w, h, x, y)``.
+
+    ``cropdetect`` runs on the keyframes only and keeps the union of the
+    picture areas it sees, so dark scenes do not shrink the result. Returns
+    ``None`` if there are no borders or the detection looks unreliable.
+    """
+
+    _check_ffmpeg()
+    width, height, _ = _probe(video)
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-nostats",
+            "-skip_frame",
+            "nokey",
+            "-i",
+            str(video),
+            "-an",
+            "-sn",
+            "-vf",
+            f"cropdetect=limit={_CROP_LIMIT}:round=2:reset=0",
+            "-f",
+            "null",
+            "-",
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    found = _CROP_RE.findall(result.stderr.decode(errors="replace"))
+    if not found:
+        return None
+    w, h, x, y = (int(v) for v in found[-1])
+    if (w, h) == (width, height):
+        return None
+    # Mostly black sources can produce a tiny area; keep the full frame then.
+    if w < width // 2 or h < height // 2:
+        return None
+    return w, h, x, y
+
+
+def _with_crop(output_args: list[str], crop: tuple[int, int, int, int] | None) -> list[str]:
+    """Prepend a ``crop`` filter so every later filter sees the cropped frame."""
+
+    if crop is None:
+        return list(output_args)
+    crop_filter = "crop={}:{}:{}:{}".format(*crop)
+    args = list(output_args)
+    if "-vf" in args:
+        i = args.index("-vf") + 1
+        args[i] = f"{crop_filter},{args[i]}"
+    else:
+        args = ["-vf", crop_filter, *args]
+    return args
+
+
+def _with_showinfo(output_args: list[str]) -> list[str]:
+    """Append a ``showinfo`` filter so frame timestamps are logged to stderr."""
+
+    args = list(output_args)
+    if "-vf" in args:
+        i = args.index("-vf") + 1
+        args[i] = f"{args[i]},showinfo"
+    else:
+        args = ["-vf", "showinfo", *args]
+    return args
+
+
+def _read_timestamps(stderr: IO[bytes], out: "queue.Queue[float | None]") -> None:
+    for line in stderr:
+        match = _PTS_RE.search(line.decode(errors="replace"))
+        if match:
+            out.put(float(match.group(1)))
+    out.put(None)
+
+
+def _parse_timestamps(stderr: bytes) -> list[float]:
+    return [float(m) for m in _PTS_RE.findall(stderr.decode(errors="replace"))]
+
+
+def _frame_times(frames: list[Path], stderr: bytes, start: float, fps: int) -> list[tuple[Path, float]]:
+    """Pair extracted ``frames`` with the timestamps ffmpeg logged for them."""
+
+    times = _parse_timestamps(stderr)
+    if len(times) != len(frames):
+        times = [i / fps for i in range(len(frames))]
+    return [(frame, start + t) for frame, t in zip(frames, times)]
+
+
+def _resolve_workers(workers: int) -> int:
+    """Return the number of ffmpeg processes to use; ``0`` means all cores."""
+
+    if workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+
+def _extract_segments(
+    video: Path,
+    workdir: Path,
+    workers: int,
+    duration: float,
+    fps: int,
+    input_args: list[str],
+    output_args: list[str],
+) -> list[tuple[Path, float]]:
+    """Extract frames with ``workers`` ffmpeg processes over disjoint time ranges.
+
+    The segment length is rounded to a multiple of ``1 / fps`` so that the
+    fixed-rate sampling grid lines up across segment boundaries. Returns the
+    frames of all segments in time order together with their timestamps.
+    """
+
+    seg_len = math.ceil(duration * fps / workers) / fps
+    threads = str(max(1, (os.cpu_count() or 1) // workers))
+    procs: list[tuple[Path, float, subprocess.Popen]] = []
+    for i in range(workers):
+        start = i * seg_len
+        if start >= duration:
+            break
+        seg_dir = workdir / f"segment_{i:03d}"
+        seg_dir.mkdir(parents=True, exist_ok=True)
+        cmd = [
+            "ffmpeg",
+            "-hide_banner",
+            "-nostats",
+            "-threads",
+            threads,
+            "-ss",
+            f"{start:.6f}",
+            "-t",
+            f"{seg_len:.6f}",
+            *input_args,
+            "-i",
+            str(video),
+            *_with_showinfo(output_args),
+            *_PNG_ARGS,
+            str(seg_dir / "frame_%06d.png"),
+        ]
+        # showinfo logs a line per frame; a file per segment keeps a full
+        # stderr pipe from stalling one process while another is waited on.
+        with open(seg_dir / "ffmpeg.log", "wb") as log:
+            proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=log)
+        procs.append((seg_dir, start, proc))
+    log_step(f"Frame Extraction running {len(procs)} segments in parallel")
+
+    failed: subprocess.CalledProcessError | None = None
+    frames: list[tuple[Path, float]] = []
+    for seg_dir, start, proc in procs:
+        proc.wait()
+        err = (seg_dir / "ffmpeg.log").read_bytes()
+        if proc.returncode != 0 and failed is None:
+            failed = subprocess.CalledProcessError(proc.returncode, proc.args, stderr=err)
+            for _, _, other in procs:
+                if other.poll() is None:
+                    other.kill()
+        if failed is None:
+            frames.extend(_frame_times(sorted(seg_dir.glob("*.png")), err, start, fps))
+    if failed is not None:
+        raise failed
+    return frames
+
+
+def estimate_count(video: Path, fps: int = 1) -> int:
+    """Return the approximate number of frames :func:`stream` will yield."""
+
+    _, _, duration = _probe(video)
+    return max(1, int(duration * fps))
+
+
+def stream(
+    video: Path,
+    fps: int = 1,
+    *,
+    mode: str = "fps",
+    scene_threshold: float = 0.3,
+    autocrop: bool = False,
+) -> Iterator[Frame]:
+    """Decode frames from ``video`` without writing them to disk.
+
+    ffmpeg writes raw ``rgb24`` frames to a pipe and every frame is yielded as
+    a :class:`Frame` holding its 1-based index, its presentation timestamp in
+    seconds and an ``(H, W, 3)`` ``uint8`` array. ``mode``,
+    ``scene_threshold`` and ``autocrop`` behave as in :func:`run`.
+    """
+    _check_video(video)
+    _check_ffmpeg()
+
+    input_args, output_args = _mode_args(mode, fps, scene_threshold)
+    width, height, _ = _probe(video)
+    crop = detect_crop(video) if autocrop else None
+    if crop is not None:
+        log_step(f"Frame Extraction cropping borders to {crop[0]}x{crop[1]}")
+        width, height = crop[:2]
+        output_args = _with_crop(output_args, crop)
+    frame_size = width * height * 3
+    log_step(f"Frame Extraction started (streaming, mode={mode})")
+    proc = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-nostats",
+            *input_args,
+            "-i",
+            str(video),
+            *_with_showinfo(output_args),
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    timestamps: "queue.Queue[float | None]" = queue.Queue()
+    reader = Thread(target=_read_timestamps, args=(proc.stderr, timestamps), daemon=True)
+    reader.start()
+    index = 0
+    try:
+        assert proc.stdout is not None
+        while True:
+            buf = proc.stdout.read(frame_size)
+            if len(buf) < frame_size:
+                break
+            index += 1
+            image = np.frombuffer(buf, dtype=np.uint8).reshape(height, width, 3)
+            try:
+                pts = timestamps.get(timeout=5)
+            except queue.Empty:
+                pts = None
+            if pts is None:
+                pts = (index - 1) / fps
+            yield Frame(index, pts, image)
+    finally:
+        if proc.stdout is not None:
+            proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        returncode = proc.wait()
+    if returncode != 0:
+        log_step(f"Frame extraction failed: ffmpeg exited with {returncode}")
+        raise subprocess.CalledProcessError(returncode, "ffmpeg")
+    log_step(f"Frame Extraction completed: {index} frames streamed")
+
+
+def run(
+    video: Path,
+    workdir: Path,
+    fps: int = 1,
+    *,
+    mode: str = "fps",
+    scene_threshold: float = 0.3,
+    workers: int = 1,
+    autocrop: bool = False,
+) -> Path:
     """Extract frames from the video using ffmpeg.
 
     Parameters
@@ -27,25 +361,73 @@ def run(video: Path, workdir: Path, fps: int = 1) -> Path:
     workdir: Path
         Directory where extracted frames will be stored.
     fps: int, optional
-        Number of frames per second to extract. Defaults to ``1``.
+        Number of frames per second to extract. Defaults to ``1``. Ignored by
+        the ``scene`` and ``keyframe`` modes.
+    mode: str, optional
+        One of :data:`EXTRACTION_MODES`. All modes except ``fps`` drop
+        redundant frames while decoding.
+    scene_threshold: float, optional
+        Minimum ffmpeg scene score (0..1) for the ``scene`` mode.
+    workers: int, optional
+        Number of ffmpeg processes that decode disjoint time ranges of the
+        video in parallel. ``0`` uses one process per CPU core.
+    autocrop: bool, optional
+        Detect letterbox and pillarbox bars once with :func:`detect_crop` and
+        crop them away while extracting.
+
+    A manifest listing every frame with its number, timestamp and source
+    video is written to ``workdir``.
     """
-    if video.suffix.lower() not in SUPPORTED_EXTS:
-        raise ValueError(f"Unsupported video format: {video.suffix}")
+    _check_video(video)
 
     _check_ffmpeg()
 
+    input_args, output_args = _mode_args(mode, fps, scene_threshold)
+    crop = detect_crop(video) if autocrop else None
+    if crop is not None:
+        log_step(f"Frame Extraction cropping borders to {crop[0]}x{crop[1]}")
+        output_args = _with_crop(output_args, crop)
     workdir.mkdir(parents=True, exist_ok=True)
-    output_pattern = workdir / "frame_%04d.png"
-    log_step("Frame Extraction started")
+    output_pattern = workdir / "frame_%06d.png"
+    workers = _resolve_workers(workers)
+    log_step(f"Frame Extraction started (mode={mode}, workers={workers})")
     try:
-        subprocess.run(
-            ["ffmpeg", "-i", str(video), "-vf", f"fps={fps}", str(output_pattern)],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
+        duration = _probe(video)[2] if workers > 1 else 0.0
+        if duration > 0:
+            frames = _extract_segments(
+                video, workdir, workers, duration, fps, input_args, output_args
+            )
+        else:
+            result = subprocess.run(
+                [
+                    "ffmpeg",
+                    "-hide_banner",
+                    "-nostats",
+                    *input_args,
+                    "-i",
+                    str(video),
+                    *_with_showinfo(output_args),
+                    *_PNG_ARGS,
+                    str(output_pattern),
+                ],
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            frames = _frame_times(sorted(workdir.glob("*.png")), result.stderr, 0.0, fps)
     except subprocess.CalledProcessError as e:
         log_step(f"Frame extraction failed: {e}")
         raise
-    log_step("Frame Extraction completed")
+
+    records = []
+    for number, (frame, pts) in enumerate(frames, 1):
+        path = workdir / f"frame_{number:06d}.png"
+        if frame != path:
+            frame.rename(path)
+        records.append(manifest.FrameRecord(number, pts, str(video), path))
+    for seg_dir in workdir.glob("segment_*"):
+        (seg_dir / "ffmpeg.log").unlink(missing_ok=True)
+        seg_dir.rmdir()
+    manifest.write(workdir, records)
+    log_step(f"Frame Extraction completed: {len(records)} frames")
     return workdir
@@ -1,14 +1,26 @@
 """Automatic upscaling and quality checking."""
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import copy
+from itertools import islice
+import os
 from pathlib import Path
-from typing import Optional
+import queue
+from threading import Event, Thread
+import time
+from typing import Callable, Iterator, Optional
 
 import numpy as np
 from PIL import Image
 import torch
 import cv2
+from onnxruntime import InferenceSession
 
+from .. import manifest
+from ..image_io import link_image, load_image, save_work
 from ..logging_utils import log_step, log_progress
+from ..upscale_cache import UpscaleCache
 
 
 try:  # Optional dependency
@@ -30,33 +42,61 @@ except Exception:  # pragma: no cover - library may not be installed
     RealESRGAN = None  # type: ignore[misc]
 
 
+# Native scales of the available RealESRGAN models. Other factors are reached
+# by resizing the output of the next larger model; the compact anime model
+# is cheaper at 4x than a dedicated 2x network.
+MODEL_SCALES = (4,)
+_WEIGHTS = {
+    4: (
+        "https://github.com/xinntao/Real-ESRGAN/releases/download/"
+        "v0.2.5.0/realesr-animevideov3.pth"
+    ),
+}
+
+
+def model_scale(factor: float) -> int:
+    """Return the native model scale used to enlarge an image by ``factor``."""
+
+    return next((s for s in MODEL_SCALES if factor <= s), MODEL_SCALES[-1])
+
+
+def _model_name(scale: int, backend: str) -> str:
+    """Identify the weights and backend used for ``scale`` in cache keys."""
+
+    if RealESRGAN is None:
+        return "lanczos"
+    return f"{Path(_WEIGHTS[scale]).stem}-{backend}"
+
+
+def _arch(scale: int) -> torch.nn.Module:
+    """Return the network architecture matching the weights for ``scale``."""
+
+    from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+
+    return SRVGGNetCompact(
+        num_in_ch=3,
+        num_out_ch=3,
+        num_feat=64,
+        num_conv=16,
+        upscale=scale,
+        act_type="prelu",
+    )
+
+
 def _load_model(device: torch.device, scale: int) -> Optional[object]:
-    """Load RealESRGAN anime model if available."""
+    """Load the RealESRGAN anime model for the native ``scale`` if available."""
 
     if RealESRGAN is None:
         log_step("RealESRGAN not available – using PIL resize")
         return None
+    scale = model_scale(scale)
     try:
         if RealESRGAN.__name__ == "RealESRGANer":  # modernes API
-            from realesrgan.archs.srvgg_arch import SRVGGNetCompact
-
-            url = (
-                "https://github.com/xinntao/Real-ESRGAN/releases/download/"
-                "v0.2.5.0/realesr-animevideov3.pth"
-            )
-            arch = SRVGGNetCompact(
-                num_in_ch=3,
-                num_out_ch=3,
-                num_feat=64,
-                num_conv=16,
-                upscale=scale,
-                act_type="prelu",
-            )
             # ``RealESRGANer`` lädt die Gewichte automatisch
             model = RealESRGAN(
                 scale=scale,
-                model_path=url,
-                model=arch,
+                model_path=_WEIGHTS[scale],
+                model=_arch(scale),
                 device=device,
                 half=False,
             )
@@ -73,6 +113,344 @@ def _load_model(device: torch.device, scale: int) -> Optional[object]:
         return None
 
 
+# ``torch`` runs the network eagerly, ``onnx`` exports it once to ONNX and runs
+# it with onnxruntime and ``onnx-int8`` additionally quantizes the weights.
+UPSCALE_BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_DIR = Path("models")
+# Side of the patch the ONNX output is compared against torch on.
+_CHECK_REGION = 96
+
+# Candidate tile sizes and overlaps tried by :func:`_tune_tile`.
+_TILE_SIZES = (128, 192, 256, 384, 512)
+_TILE_PADS = (8, 16)
+# Side of the region of the first frame the candidates are timed on.
+_TUNE_REGION = 512
+# Feature channels of the RealESRGAN networks, used to estimate activations.
+_FEATURES = 64
+# Frames decoded together so their tiles can share forward passes.
+_FRAME_BATCH = 4
+# Decoded batches waiting for inference and encoder threads for the results.
+# At most ``2 * _WRITERS`` results wait to be written.
+_PREFETCH = 2
+_WRITERS = 2
+
+Forward = Callable[[np.ndarray], np.ndarray]
+
+
+def _network(model: object | None) -> Optional[torch.nn.Module]:
+    """Return the torch network wrapped by a loaded RealESRGAN model."""
+
+    net = getattr(model, "model", None)
+    return net if isinstance(net, torch.nn.Module) else None
+
+
+def _torch_forward(net: torch.nn.Module, device: torch.device) -> Forward:
+    """Wrap ``net`` as a function from ``(B, H, W, 3)`` to upscaled ``uint8``."""
+
+    dtype = next(net.parameters()).dtype
+
+    def forward(tiles: np.ndarray) -> np.ndarray:
+        x = torch.from_numpy(tiles).to(device=device, dtype=dtype)
+        x = x.permute(0, 3, 1, 2).div_(255)
+        with torch.no_grad():  # pragma: no cover - heavy model inference
+            y = net(x)
+        y = y.float().clamp_(0, 1).mul_(255).round_().to(torch.uint8)
+        return y.permute(0, 2, 3, 1).cpu().numpy()
+
+    return forward
+
+
+def _onnx_path(net: torch.nn.Module, scale: int, quantized: bool) -> Path:
+    suffix = "_int8" if quantized else ""
+    return ONNX_DIR / f"{type(net).__name__.lower()}_x{scale}{suffix}.onnx"
+
+
+def _load_onnx(
+    net: torch.nn.Module, scale: int, quantized: bool, device: torch.device
+) -> InferenceSession:
+    """Export ``net`` to ONNX on first use and open it with onnxruntime.
+
+    The exported model, and its dynamically int8 quantized variant, are
+    cached in :data:`ONNX_DIR` and reused by later jobs.
+    """
+
+    path = _onnx_path(net, scale, quantized)
+    if not path.exists():
+        float_path = _onnx_path(net, scale, False)
+        if not float_path.exists():
+            log_step(f"Exporting upscaler to {float_path}")
+            ONNX_DIR.mkdir(parents=True, exist_ok=True)
+            export = copy.deepcopy(net).float().cpu().eval()
+            axes = {0: "batch", 2: "height", 3: "width"}
+            # Written under a temporary name so an interrupted export is
+            # never picked up by later jobs.
+            tmp = float_path.with_name(f".{float_path.name}")
+            torch.onnx.export(
+                export,
+                torch.rand(1, 3, 64, 64),
+                str(tmp),
+                input_names=["input"],
+                output_names=["output"],
+                dynamic_axes={"input": axes, "output": axes},
+                opset_version=17,
+            )
+            os.replace(tmp, float_path)
+        if quantized:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            log_step(f"Quantizing upscaler to {path}")
+            tmp = path.with_name(f".{path.name}")
+            quantize_dynamic(str(float_path), str(tmp), weight_type=QuantType.QInt8)
+            os.replace(tmp, path)
+
+    providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
+    if device.type == "cpu" or quantized:
+        providers = ["CPUExecutionProvider"]
+    return InferenceSession(str(path), providers=providers)
+
+
+def _onnx_forward(session: InferenceSession) -> Forward:
+    """Wrap an ONNX upscaler like :func:`_torch_forward`."""
+
+    name = session.get_inputs()[0].name
+
+    def forward(tiles: np.ndarray) -> np.ndarray:
+        x = np.ascontiguousarray(tiles.transpose(0, 3, 1, 2), dtype=np.float32) / 255
+        (y,) = session.run(None, {name: x})
+        y = np.clip(y, 0, 1) * 255
+        return np.rint(y).astype(np.uint8).transpose(0, 2, 3, 1)
+
+    return forward
+
+
+def _psnr(a: np.ndarray, b: np.ndarray) -> float:
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float("inf") if mse == 0 else float(10 * np.log10(255**2 / mse))
+
+
+def _check_backend(
+    forward: Forward, reference: Forward, sample: np.ndarray, min_psnr: float
+) -> bool:
+    """Return whether ``forward`` matches ``reference`` on a patch of ``sample``."""
+
+    patch = sample[None, :_CHECK_REGION, :_CHECK_REGION].copy()
+    psnr = _psnr(forward(patch), reference(patch))
+    log_step(f"Upscaling backend PSNR against torch: {psnr:.1f} dB")
+    return psnr >= min_psnr
+
+
+def _tile_memory(tile: int, pad: int, scale: int, batch: int) -> int:
+    """Estimate the peak bytes of one forward pass over ``batch`` tiles."""
+
+    side = tile + 2 * pad
+    return batch * side * side * 4 * (2 * _FEATURES + 3 * scale * scale)
+
+
+def _positions(size: int, tile: int) -> list[int]:
+    """Tile offsets along one axis; the last tile is moved back to fit."""
+
+    return sorted({min(i, size - tile) for i in range(0, size, tile)})
+
+
+def _upscale_tiled(
+    forward: Forward,
+    images: list[np.ndarray],
+    scale: int,
+    tile: int,
+    pad: int,
+    batch: int,
+) -> list[np.ndarray]:
+    """Upscale ``images`` tile by tile, batching tiles across all images.
+
+    Each tile is read with ``pad`` pixels of overlap on every side and only
+    its centre is kept, which hides seams between tiles. Tiles of the same
+    shape are stacked into forward passes of up to ``batch`` tiles.
+    """
+
+    outputs = [np.empty((h * scale, w * scale, 3), np.uint8) for h, w, _ in (i.shape for i in images)]
+    groups: dict[tuple[int, int], list[tuple[int, int, int, np.ndarray]]] = {}
+    for idx, img in enumerate(images):
+        h, w = img.shape[:2]
+        th, tw = min(tile, h), min(tile, w)
+        padded = np.pad(img, ((pad, pad), (pad, pad), (0, 0)), mode="reflect")
+        for y in _positions(h, th):
+            for x in _positions(w, tw):
+                region = padded[y : y + th + 2 * pad, x : x + tw + 2 * pad]
+                groups.setdefault((th, tw), []).append((idx, y, x, region))
+    for (th, tw), tiles in groups.items():
+        for i in range(0, len(tiles), batch):
+            chunk = tiles[i : i + batch]
+            result = forward(np.stack([t[3] for t in chunk]))
+            for (idx, y, x, _), out in zip(chunk, result):
+                core = out[pad * scale : (pad + th) * scale, pad * scale : (pad + tw) * scale]
+                outputs[idx][y * scale : (y + th) * scale, x * scale : (x + tw) * scale] = core
+    return outputs
+
+
+def _tune_tile(
+    forward: Forward,
+    sample: np.ndarray,
+    scale: int,
+    batch: int,
+    memory_limit_mb: int,
+) -> tuple[int, int]:
+    """Return the fastest ``(tile, pad)`` on ``sample`` within the memory limit.
+
+    Candidates are timed on a region of up to :data:`_TUNE_REGION` pixels and
+    compared by time per output pixel.
+    """
+
+    region = sample[:_TUNE_REGION, :_TUNE_REGION]
+    limit = memory_limit_mb * 1024 * 1024
+    longest = max(region.shape[:2])
+    candidates = [
+        (tile, pad)
+        for tile in _TILE_SIZES
+        for pad in _TILE_PADS
+        if tile <= max(longest, _TILE_SIZES[0])
+        and _tile_memory(tile, pad, scale, batch) <= limit
+    ]
+    if not candidates:
+        return _TILE_SIZES[0], _TILE_PADS[0]
+    _upscale_tiled(forward, [region], scale, candidates[0][0], candidates[0][1], batch)
+    timings = {}
+    for tile, pad in candidates:
+        start = time.perf_counter()
+        _upscale_tiled(forward, [region], scale, tile, pad, batch)
+        timings[(tile, pad)] = time.perf_counter() - start
+    best = min(timings, key=timings.get)
+    log_step(f"Upscaling tile tuned: tile={best[0]}, pad={best[1]}")
+    return best
+
+
+class _Upscaler:
+    """Enlarges images by the native ``scale`` of one loaded model.
+
+    Holds the backend chosen for the model and the tile size, which is tuned
+    on the first images it sees when ``tile`` is ``0``.
+    """
+
+    def __init__(
+        self,
+        model: object | None,
+        scale: int,
+        device: torch.device,
+        *,
+        tile: int | None,
+        tile_pad: int,
+        tile_batch: int,
+        memory_limit_mb: int,
+        backend: str,
+        min_psnr: float,
+    ) -> None:
+        self.model = model
+        self.scale = scale
+        self.tile = tile
+        self.tile_pad = tile_pad
+        self.tile_batch = tile_batch
+        self.memory_limit_mb = memory_limit_mb
+        self.backend = backend
+        self.min_psnr = min_psnr
+        self.forward: Forward | None = None
+        self.reference: Forward | None = None
+        if tile is not None or backend != "torch":
+            net = _network(model)
+            if net is None:
+                log_step("No RealESRGAN network – using the default upscaler")
+                self.backend = "torch"
+            elif backend == "torch":
+                self.forward = _torch_forward(net, device)
+            else:
+                session = _load_onnx(net, scale, backend == "onnx-int8", device)
+                self.forward = _onnx_forward(session)
+                self.reference = _torch_forward(net, device)
+
+    @property
+    def name(self) -> str:
+        return "lanczos" if self.model is None else _model_name(self.scale, self.backend)
+
+    def upscale(self, images: list[Image.Image]) -> list[Image.Image]:
+        if self.forward is None:
+            out = []
+            for img in images:
+                if self.model is not None:
+                    with torch.no_grad():  # pragma: no cover - heavy model inference
+                        up, _ = self.model.enhance(np.array(img))
+                    out.append(Image.fromarray(up))
+                else:
+                    width, height = img.size
+                    out.append(img.resize((width * self.scale, height * self.scale), Image.LANCZOS))
+            return out
+
+        arrays = [np.asarray(img) for img in images]
+        if self.reference is not None:
+            if not _check_backend(self.forward, self.reference, arrays[0], self.min_psnr):
+                log_step(f"Upscaling backend {self.backend} too inaccurate – using torch")
+                self.forward = self.reference
+                self.backend = "torch"
+            self.reference = None
+        if self.tile == 0:
+            self.tile, self.tile_pad = _tune_tile(
+                self.forward, arrays[0], self.scale, self.tile_batch, self.memory_limit_mb
+            )
+        if self.tile is None:
+            # Whole frames, one per forward pass.
+            size = max(max(a.shape[:2]) for a in arrays)
+            outs = _upscale_tiled(self.forward, arrays, self.scale, size, self.tile_pad, 1)
+        else:
+            outs = _upscale_tiled(
+                self.forward, arrays, self.scale, self.tile, self.tile_pad, self.tile_batch
+            )
+        return [Image.fromarray(o) for o in outs]
+
+
+def _plan(
+    size: tuple[int, int], scale: float, target_size: int | None, target_side: str
+) -> float | None:
+    """Return the factor to enlarge an image of ``size`` by, ``None`` to keep it."""
+
+    if target_size is None:
+        return scale
+    width, height = size
+    side = min(width, height) if target_side == "short" else max(width, height)
+    if side >= target_size:
+        return None
+    return target_size / side
+
+
+def _decode(
+    batches: Iterator[list[manifest.FrameRecord]],
+    out: "queue.Queue[object]",
+    stop: Event,
+    check_quality: bool,
+    blur_thresh: float,
+    dark_thresh: float,
+) -> None:
+    """Decode ``batches`` into ``out``; rejected frames become ``None``.
+
+    Runs in its own thread. The end is marked with ``None`` and errors are
+    passed on to the consumer. Once ``stop`` is set no further batch is
+    decoded; the consumer drains ``out`` so a pending ``put`` returns.
+    """
+
+    try:
+        for batch in batches:
+            if stop.is_set():
+                return
+            images: list[Image.Image | None] = []
+            for rec in batch:
+                with load_image(rec.path) as src:
+                    img = src.convert("RGB")
+                if check_quality and not _is_acceptable(img, blur_thresh, dark_thresh):
+                    img = None
+                images.append(img)
+            out.put((batch, images))
+    except BaseException as exc:  # handed to the consumer thread
+        out.put(exc)
+        return
+    out.put(None)
+
+
 def _is_acceptable(img: Image.Image, blur_thresh: float, dark_thresh: float) -> bool:
     """Return ``True`` if image passes basic quality checks."""
 
@@ -94,36 +472,212 @@ def run(
     blur_threshold: float = 100.0,
     dark_threshold: float = 40.0,
     model: object | None = None,
+    models: dict[int, object] | None = None,
     device: torch.device | None = None,
+    work_format: str = "png",
+    check_quality: bool = True,
+    tile: int | None = None,
+    tile_pad: int = 10,
+    tile_batch: int = 8,
+    memory_limit_mb: int = 2048,
+    backend: str = "torch",
+    min_psnr: float = 35.0,
+    target_size: int | None = None,
+    target_side: str = "short",
+    cache: UpscaleCache | None = None,
 ) -> Path:
-    """Upscale images with RealESRGAN and drop low-quality frames."""
+    """Upscale images with RealESRGAN and drop low-quality frames.
+
+    Upscaled images are written in ``work_format`` (see
+    :data:`pipeline.image_io.WORK_FORMATS`). The blur and darkness check on
+    the full-resolution frame only runs with ``check_quality``; disable it
+    when :func:`pipeline.steps.filtering.run` already removed those frames.
+
+    Parameters
+    ----------
+    scale: int, optional
+        Fixed enlargement factor when no ``target_size`` is given. Factors
+        other than :data:`MODEL_SCALES` resize the output of the next larger
+        model.
+    model: object | None, optional
+        Loaded model for ``model_scale(scale)``.
+    models: dict[int, object] | None, optional
+        Loaded models keyed by native scale. Missing scales are loaded on
+        first use.
+    tile: int | None, optional
+        ``None`` enhances whole frames. Otherwise frames are split into tiles
+        of this size, overlapping by ``tile_pad`` pixels, and the tiles of
+        several frames are upscaled together in forward passes of
+        ``tile_batch`` tiles. ``0`` benchmarks a few tile and overlap sizes on
+        the first frame and keeps the fastest one whose estimated memory use
+        stays below ``memory_limit_mb``.
+    backend: str, optional
+        One of :data:`UPSCALE_BACKENDS`. The ONNX backends are checked against
+        torch on the first frame and fall back to torch if the PSNR of their
+        output is below ``min_psnr``.
+    target_size: int | None, optional
+        Desired length in pixels of the ``target_side`` (``short`` or
+        ``long``). The factor is chosen per image, images that already reach
+        the target are kept as they are and results that overshoot are
+        downscaled to the target. Images that would need more than
+        ``max(MODEL_SCALES)`` are enlarged by that and stay below the target;
+        they are counted in the completion message.
+    cache: UpscaleCache | None, optional
+        Reuse upscaled images from earlier runs. Entries are keyed by the
+        source pixels, model, backend and output size; the cache is trimmed
+        after the run and its hit rate is logged.
+
+    Frames are decoded ahead in a separate thread and results are encoded by
+    a small writer pool, both behind bounded queues, so the model runs on the
+    main thread without waiting for image I/O.
+    """
 
     workdir.mkdir(parents=True, exist_ok=True)
     log_step("Upscaling started")
 
     if device is None:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    if model is None:
-        model = _load_model(device, scale)
-
-    images = sorted(filtered_dir.glob("*.png"))
-    total = len(images)
-    for idx, img_path in enumerate(images, 1):
-        with Image.open(img_path).convert("RGB") as img:
-            if not _is_acceptable(img, blur_threshold, dark_threshold):
-                continue
-
-            if model is not None:
-                with torch.no_grad():  # pragma: no cover - heavy model inference
-                    upscaled, _ = model.enhance(np.array(img))
-                up_img = Image.fromarray(upscaled)
-            else:
-                width, height = img.size
-                up_img = img.resize((width * scale, height * scale), Image.LANCZOS)
+    if backend not in UPSCALE_BACKENDS:
+        raise ValueError(f"Unknown upscaling backend: {backend}")
+    loaded = {s: m for s, m in (models or {}).items() if m is not None}
+    if model is not None:
+        loaded[model_scale(scale)] = model
+    upscalers: dict[int, _Upscaler] = {}
+
+    def _upscaler(native: int) -> _Upscaler:
+        if native not in upscalers:
+            m = loaded.get(native) or _load_model(device, native)
+            upscalers[native] = _Upscaler(
+                m,
+                native,
+                device,
+                tile=tile,
+                tile_pad=tile_pad,
+                tile_batch=tile_batch,
+                memory_limit_mb=memory_limit_mb,
+                backend=backend,
+                min_psnr=min_psnr,
+            )
+        return upscalers[native]
+
+    def _cache_name(native: int) -> str:
+        # Once an upscaler exists, key by the backend it really uses.
+        if native in upscalers:
+            return upscalers[native].name
+        return _model_name(native, backend)
+
+    def _write(
+        rec: manifest.FrameRecord,
+        up_img: Image.Image,
+        size: tuple[int, int],
+        key: str | None,
+        cacheable: bool,
+    ) -> None:
+        if up_img.size != size:
+            up_img = up_img.resize(size, Image.LANCZOS)
+        rec.path = save_work(up_img, workdir / rec.path.name, work_format)
+        if key is not None and cacheable:
+            cache.put(key, rec.path)
+
+    def _restore(rec: manifest.FrameRecord, cached: Path) -> None:
+        dst = workdir / rec.path.name
+        if cached.suffix == f".{work_format}":
+            rec.path = link_image(cached, dst.with_suffix(cached.suffix))
+        else:
+            with load_image(cached) as hit:
+                rec.path = save_work(hit, dst, work_format)
+
+    frame_batch = _FRAME_BATCH if tile is not None or backend != "torch" else 1
+    records = manifest.read(filtered_dir)
+    kept: list[manifest.FrameRecord] = []
+    skipped = 0
+    capped = 0
+    total = len(records)
+    done = 0
+    it = iter(records)
+    batches = iter(lambda: list(islice(it, frame_batch)), [])
+    decoded: "queue.Queue[object]" = queue.Queue(maxsize=_PREFETCH)
+    stop = Event()
+    Thread(
+        target=_decode,
+        args=(batches, decoded, stop, check_quality, blur_threshold, dark_threshold),
+        daemon=True,
+    ).start()
+    pending: deque[Future] = deque()
+
+    def _submit(writers: ThreadPoolExecutor, fn: Callable, *args: object) -> None:
+        pending.append(writers.submit(fn, *args))
+        while len(pending) > 2 * _WRITERS:
+            pending.popleft().result()
+
+    try:
+        with ThreadPoolExecutor(max_workers=_WRITERS) as writers:
+            while (item := decoded.get()) is not None:
+                if isinstance(item, BaseException):
+                    raise item
+                batch, images = item
+                results: dict[int, manifest.FrameRecord] = {}
+                groups: dict[int, list[tuple[int, Image.Image, tuple[int, int], str | None]]] = {}
+                for pos, (rec, img) in enumerate(zip(batch, images)):
+                    if img is None:
+                        continue
+                    factor = _plan(img.size, scale, target_size, target_side)
+                    if factor is None:
+                        # Already large enough; the manifest keeps pointing at it.
+                        results[pos] = rec
+                        skipped += 1
+                        continue
+                    native = model_scale(factor)
+                    if target_size is not None:
+                        if factor > native:
+                            capped += 1
+                        factor = min(factor, native)
+                    size = (round(img.width * factor), round(img.height * factor))
+                    key = None
+                    if cache is not None:
+                        key = cache.key(img, _cache_name(native), size)
+                        cached = cache.get(key)
+                        if cached is not None:
+                            _submit(writers, _restore, rec, cached)
+                            results[pos] = rec
+                            continue
+                    groups.setdefault(native, []).append((pos, img, size, key))
 
-            out_path = workdir / img_path.name
-            up_img.save(out_path)
-        log_progress("Upscaling", idx, total)
+                for native, items in groups.items():
+                    upscaler = _upscaler(native)
+                    looked_up = _cache_name(native)
+                    upscaled = upscaler.upscale([img for _, img, _, _ in items])
+                    # A failed model load falls back to PIL; do not cache that.
+                    cacheable = upscaler.model is not None or RealESRGAN is None
+                    for (pos, img, size, key), up_img in zip(items, upscaled):
+                        if key is not None and upscaler.name != looked_up:
+                            # The backend fell back while upscaling this batch.
+                            key = cache.key(img, upscaler.name, size)
+                        _submit(writers, _write, batch[pos], up_img, size, key, cacheable)
+                        results[pos] = batch[pos]
+                kept.extend(results[pos] for pos in sorted(results))
+                done += len(batch)
+                log_progress("Upscaling", done, total)
+            while pending:
+                pending.popleft().result()
+    finally:
+        # On errors the decoder may be blocked on the full queue; release it.
+        stop.set()
+        while True:
+            try:
+                decoded.get_nowait()
+            except queue.Empty:
+                break
 
-    log_step("Upscaling completed")
+    manifest.write(workdir, kept)
+    if cache is not None:
+        cache.log_stats()
+        cache.evict()
+    if target_size is not None:
+        log_step(
+            f"Upscaling completed: {skipped} images already met the target, "
+            f"{capped} stayed below it at the {max(MODEL_SCALES)}x limit"
+        )
+    else:
+        log_step("Upscaling completed")
     return workdir
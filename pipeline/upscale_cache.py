@@ -0,0 +1,113 @@
+"""Content-addressed cache of upscaled images.
+
+Entries are keyed by a hash of the source pixels together with the model and
+output size, so re-running a video with different cropping or tagging
+settings reuses earlier upscaling results. The cache is trimmed to a size
+limit by deleting the least recently used entries.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+from pathlib import Path
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from .image_io import link_image
+from .logging_utils import log_step
+
+CACHE_DIR = Path("cache/upscale")
+
+
+class UpscaleCache:
+    """Upscaled images stored as ``<dir>/<key[:2]>/<key>.<ext>``.
+
+    Parameters
+    ----------
+    directory: Path
+        Cache directory, created on first use.
+    max_bytes: int
+        Size the cache is trimmed to by :meth:`evict`.
+    """
+
+    def __init__(self, directory: Path = CACHE_DIR, max_bytes: int = 10 * 1024**3) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(img: Image.Image, model: str, size: tuple[int, int]) -> str:
+        """Return the cache key of ``img`` upscaled by ``model`` to ``size``."""
+
+        h = hashlib.blake2b(digest_size=16)
+        pixels = np.asarray(img)
+        h.update(f"{pixels.shape}|{model}|{size[0]}x{size[1]}".encode())
+        h.update(pixels.tobytes())
+        return h.hexdigest()
+
+    def _entry(self, key: str) -> Path | None:
+        folder = self.directory / key[:2]
+        return next(folder.glob(f"{key}.*"), None) if folder.is_dir() else None
+
+    def get(self, key: str) -> Path | None:
+        """Return the cached file for ``key`` and mark it as recently used."""
+
+        path = self._entry(key)
+        if path is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(path)
+        return path
+
+    def put(self, key: str, path: Path) -> None:
+        """Store the image file ``path`` under ``key``, hardlinking if possible."""
+
+        dst = self.directory / key[:2] / f"{key}{path.suffix}"
+        if dst.exists():
+            return
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        # Writer threads may store the same key at once, so every put links
+        # through its own temporary name; replacing an existing entry with
+        # identical content is harmless.
+        fd, name = tempfile.mkstemp(dir=dst.parent, prefix=f".{dst.name}.", suffix=".tmp")
+        os.close(fd)
+        tmp = Path(name)
+        try:
+            tmp.unlink()
+            link_image(path, tmp)
+            os.replace(tmp, dst)
+        finally:
+            tmp.unlink(missing_ok=True)
+        os.utime(dst)
+
+    def evict(self) -> int:
+        """Delete least recently used entries above ``max_bytes``.
+
+        Returns the number of deleted entries.
+        """
+
+        if not self.directory.is_dir():
+            return 0
+        entries = []
+        for path in self.directory.glob("*/*"):
+            st = path.stat()
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def log_stats(self) -> None:
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0.0
+        log_step(f"Upscale cache: {self.hits}/{lookups} hits ({rate:.0f}%)")